@@ -8,29 +8,50 @@ def aesgcm_encrypt(plaintext: str, shared_secret: bytes) -> tuple[str, str]:
     Returns a tuple containing the nonce and ciphertext, each of which are a base64 encoded string.
     '''
 
-    # Generate a random 12-byte nonce (number once or 'nonce' is a random number that should only be used once)
-    nonce = os.urandom(12)
+    return aesgcm_encrypt_with(AESGCM(shared_secret), plaintext)
+
+def aesgcm_decrypt(nonce_b64: str, ciphertext_b64: str, shared_secret: bytes) -> str:
+    '''
+    Returns the plaintext as a string.
+    '''
+
+    return aesgcm_decrypt_with(AESGCM(shared_secret), nonce_b64, ciphertext_b64)
+
+def aesgcm_encrypt_with(aesgcm: AESGCM, plaintext: str) -> tuple[str, str]:
+    '''
+    Same as aesgcm_encrypt, but reuses an existing AESGCM cipher object instead of setting up the key again.
+    '''
 
-    # Encrypt the plaintext
-    aesgcm = AESGCM(shared_secret)
-    plaintext_bytes = plaintext.encode()
-    ciphertext = aesgcm.encrypt(nonce, plaintext_bytes, None)
+    nonce, ciphertext = aesgcm_encrypt_bytes(aesgcm, plaintext.encode())
 
     nonce_b64 = base64.b64encode(nonce).decode()
     ciphertext_b64 = base64.b64encode(ciphertext).decode()
     return nonce_b64, ciphertext_b64
 
-def aesgcm_decrypt(nonce_b64: str, ciphertext_b64: str, shared_secret: bytes) -> str:
+def aesgcm_decrypt_with(aesgcm: AESGCM, nonce_b64: str, ciphertext_b64: str) -> str:
     '''
-    Returns the plaintext as a string.
+    Same as aesgcm_decrypt, but reuses an existing AESGCM cipher object instead of setting up the key again.
     '''
 
     # Convert from base64 encoded string to bytes
     nonce = base64.b64decode(nonce_b64)
     ciphertext = base64.b64decode(ciphertext_b64)
 
-    # Decrypt the ciphertext
-    aesgcm = AESGCM(shared_secret)
-    plaintext_bytes = aesgcm.decrypt(nonce, ciphertext, None)
+    return aesgcm_decrypt_bytes(aesgcm, nonce, ciphertext).decode()  # Convert from bytes to str
+
+def aesgcm_encrypt_bytes(aesgcm: AESGCM, plaintext: bytes) -> tuple[bytes, bytes]:
+    '''
+    Returns a tuple containing the raw nonce and ciphertext, for callers that do not need base64.
+    '''
+
+    # Generate a random 12-byte nonce (number once or 'nonce' is a random number that should only be used once)
+    nonce = os.urandom(12)
+    ciphertext = aesgcm.encrypt(nonce, plaintext, None)
+    return nonce, ciphertext
+
+def aesgcm_decrypt_bytes(aesgcm: AESGCM, nonce: bytes, ciphertext: bytes) -> bytes:
+    '''
+    Returns the raw plaintext bytes.
+    '''
 
-    return plaintext_bytes.decode()  # Convert from bytes to str
\ No newline at end of file
+    return aesgcm.decrypt(nonce, ciphertext, None)
@@ -0,0 +1,139 @@
+import copy
+import time
+import numpy as np
+
+
+def _squared_distances(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    return np.maximum(np.einsum('ij,ij->i', a, a)[:, None] + np.einsum('ij,ij->i', b, b)[None, :] - 2.0 * (a @ b.T), 0.0)
+
+
+class IVFIndex():
+    '''
+    Approximate nearest-neighbour index over the encodings matrix (inverted file).
+
+    k-means splits the rows into nlist cells. A query scans only the rows in the nprobe cells whose
+    centroids are closest to it, and the caller re-ranks those candidates with exact distances. New rows
+    can be added without retraining: they go to their nearest existing centroid. Raising nprobe trades
+    latency for recall, and nprobe = nlist is an exact scan.
+    '''
+
+    def __init__(self, nlist: int = None, nprobe: int = 8, train_iterations: int = 10, seed: int = 0):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.train_iterations = train_iterations
+        self.seed = seed
+        self.centroids = None
+        self.lists = []
+        self.rows = 0
+        self.trained_rows = 0
+        self.last_recall = None
+
+    def _assign(self, rows: np.ndarray) -> np.ndarray:
+        return np.argmin(_squared_distances(rows, self.centroids), axis=1)
+
+    def build(self, matrix: np.ndarray) -> None:
+        '''
+        Trains the centroids with k-means on (a sample of) the matrix and assigns every row to a cell.
+        '''
+
+        matrix = np.asarray(matrix, dtype=np.float64)
+        nlist = self.nlist or max(1, int(np.sqrt(len(matrix))))
+        nlist = min(nlist, len(matrix))
+        rng = np.random.default_rng(self.seed)
+        sample = matrix[rng.choice(len(matrix), size=min(len(matrix), 256 * nlist), replace=False)]
+
+        centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+        for _ in range(self.train_iterations):
+            assignment = np.argmin(_squared_distances(sample, centroids), axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            counts = np.bincount(assignment, minlength=nlist)
+            filled = counts > 0
+            centroids[filled] = sums[filled] / counts[filled, None]
+        self.centroids = centroids
+
+        self.lists = [np.empty(0, dtype=np.int64) for _ in range(nlist)]
+        self.rows = 0
+        self.add(matrix)
+        self.trained_rows = len(matrix)
+
+    def add(self, rows: np.ndarray) -> None:
+        '''
+        Adds rows that were appended to the matrix; their ids continue from the rows already indexed.
+        '''
+
+        if len(rows) == 0:
+            return
+        assignment = self._assign(np.asarray(rows, dtype=np.float64))
+        ids = np.arange(self.rows, self.rows + len(rows))
+        for cell in np.unique(assignment):
+            self.lists[cell] = np.concatenate([self.lists[cell], ids[assignment == cell]])
+        self.rows += len(rows)
+
+    def extended(self, rows: np.ndarray) -> 'IVFIndex':
+        '''
+        Returns a copy of the index with rows added, leaving this one as it is for the matchers still using it.
+        '''
+
+        ann = copy.copy(self)
+        ann.lists = list(self.lists) # add() replaces the cells it changes rather than growing them in place
+        ann.add(rows)
+        return ann
+
+    def candidates(self, probe: np.ndarray, nprobe: int = None) -> np.ndarray:
+        '''
+        Returns the ids of the rows in the nprobe cells closest to the probe.
+        '''
+
+        nprobe = min(nprobe or self.nprobe, len(self.lists))
+        distances = _squared_distances(probe[None, :], self.centroids)[0]
+        cells = np.argpartition(distances, nprobe - 1)[:nprobe]
+        return np.concatenate([self.lists[cell] for cell in cells])
+
+    def search(self, matrix: np.ndarray, probe: np.ndarray, k: int, nprobe: int = None) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        Returns the ids and exact distances of the (approximately) k nearest rows, nearest first.
+        '''
+
+        ids = self.candidates(probe, nprobe)
+        distances = np.sqrt(_squared_distances(probe[None, :], np.asarray(matrix[ids]))[0])
+        k = min(k, len(ids))
+        if k == 0:
+            return ids, distances
+        best = np.argpartition(distances, k - 1)[:k]
+        best = best[np.argsort(distances[best])]
+        return ids[best], distances[best]
+
+    def measure_recall(self, matrix: np.ndarray, probes: np.ndarray, k: int = 10, nprobe: int = None) -> dict:
+        '''
+        Compares search against a brute-force scan: recall is the fraction of the true k nearest rows found.
+        '''
+
+        matrix = np.asarray(matrix, dtype=np.float64)
+        start = time.perf_counter()
+        approximate = [set(self.search(matrix, probe, k, nprobe)[0].tolist()) for probe in probes]
+        ann_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        distances = _squared_distances(probes, matrix)
+        exact = np.argsort(distances, axis=1)[:, :k]
+        exact_seconds = time.perf_counter() - start
+
+        found = sum(len(approximate[i] & set(exact[i].tolist())) for i in range(len(probes)))
+        self.last_recall = {
+            'k': k,
+            'nprobe': nprobe or self.nprobe,
+            'recall': found / max(1, exact.size),
+            'ann_ms_per_query': 1000 * ann_seconds / max(1, len(probes)),
+            'exact_ms_per_query': 1000 * exact_seconds / max(1, len(probes))
+        }
+        return self.last_recall
+
+    def stats(self) -> dict:
+        return {
+            'nlist': len(self.lists),
+            'nprobe': self.nprobe,
+            'rows': self.rows,
+            'trained_rows': self.trained_rows,
+            'last_recall': self.last_recall
+        }
@@ -1,40 +1,48 @@
-import json
 import urllib.parse
 import logging
 import os
-import shutil
 import time
 import hmac
-import pickle
 import hashlib
-import numpy as np
+import uuid
+import shutil
+import msgspec
 from advanced_alchemy.extensions.litestar.plugins.init.config.asyncio import autocommit_before_send_handler
-from collections.abc import AsyncGenerator
-from litestar import Litestar, get, post, Request, put, delete
+from collections.abc import AsyncGenerator, AsyncIterator
+from litestar import Litestar, get, post, Request, Response, put, delete
 from litestar.plugins.sqlalchemy import SQLAlchemyAsyncConfig, SQLAlchemyPlugin
 from litestar.config.cors import CORSConfig
 from litestar.enums import RequestEncodingType
 from litestar.params import Body
 from litestar.exceptions import HTTPException
-from pydantic import BaseModel, ConfigDict
-from sqlalchemy import select
-from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
+from pydantic import BaseModel, ConfigDict, ValidationError
+from sqlalchemy import event, select
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.ext.mutable import MutableDict
-from sqlalchemy.types import JSON
-from typing import Annotated, Any
+from typing import Annotated, Optional, Union
 from litestar.datastructures import UploadFile
 from dotenv import load_dotenv
-from copy import deepcopy
-from encryption_helper import EncryptionHelper
-from video_encoding import convert_to_mp4, split_frames
-from train_model import train_model
-from aesgcm_encryption import aesgcm_encrypt, aesgcm_decrypt
+from encryption_helper import EncryptionHelper, BINARY_MEDIA_TYPE
+from session_store import build_session_store
+from models import Base, Device, FaceRegistrationJob, DEFAULT_PREFS, JOB_QUEUED, JOB_DONE, JOB_FAILED
+from video_encoding import stream_frames
+from face_worker import frame_encodings, save_encodings
+from face_encoder import load_models
+from executors import BoundedExecutor
+from encodings_store import EncodingsStore, ENCODING_DIM
+from encodings_cache import EncodingsCache
+from face_matching import DEFAULT_TOLERANCE
+from encodings_codec import ENCODING_FORMATS, EncodingFormatError, decode_matrix
+from aesgcm_encryption import aesgcm_encrypt_with, aesgcm_decrypt_with
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
 load_dotenv(os.path.join(os.path.dirname(__file__), '.env'))
 
-AES_KEY = os.environ.get('AES_KEY')
+AES_KEY = os.environ.get('AES_KEY') or None
+SESSION_STORE = os.environ.get('SESSION_STORE', 'memory') # memory, sqlite or redis
 
+if AES_KEY is None and SESSION_STORE != 'memory':
+    # Every worker would generate its own key and couldn't unwrap the secrets (or passwords) of the others
+    raise RuntimeError(f'AES_KEY must be set when SESSION_STORE={SESSION_STORE}, and be the same for every process')
 if AES_KEY is None: # Set AES_KEY for database if not set
     AES_KEY = os.urandom(32)
     with open('.env', 'a') as f:
@@ -42,31 +50,48 @@ if AES_KEY is None: # Set AES_KEY for database if not set
 else:
     AES_KEY = bytes.fromhex(AES_KEY)
 
-json_path = os.path.join(os.path.dirname(__file__), 'json_example.json')
-with open(json_path, 'r') as f:
-    DEFAULT_PREFS = json.load(f)
-
-encryption_helper = EncryptionHelper()
-
-
-class Base(DeclarativeBase):
-    pass
-
-
-class Device(Base):
-    __tablename__ = 'devices'
-
-    mac_address: Mapped[str] = mapped_column(primary_key=True)
-    username: Mapped[str]
-    password: Mapped[str]
-    nonce: Mapped[str]
-    secret: Mapped[str] # Shared secret used in TOTP, maybe encrypt?
-    totp_timestamp: Mapped[int]
-    preferences: Mapped[MutableDict[str, Any]] = mapped_column(
-        MutableDict.as_mutable(JSON),
-        default=lambda: deepcopy(DEFAULT_PREFS),
-        nullable=False
-    )
+DB_CIPHER = AESGCM(AES_KEY) # used for passwords stored in the database
+
+KEM_SESSION_TTL = float(os.environ.get('KEM_SESSION_TTL_SECONDS', 60))
+SESSION_TTL = float(os.environ.get('SESSION_TTL_SECONDS', 86400))
+SESSION_MAX_ENTRIES = int(os.environ.get('SESSION_MAX_ENTRIES', 10000))
+SESSION_STORE_URL = os.environ.get('SESSION_STORE_URL')
+
+if SESSION_STORE == 'memory':
+    kem_sessions, shared_secrets = None, None
+else: # shared between worker processes, secrets wrapped under AES_KEY
+    kem_sessions = build_session_store(SESSION_STORE, 'kem', KEM_SESSION_TTL, SESSION_MAX_ENTRIES, AES_KEY, SESSION_STORE_URL,
+                                       cache_ttl=None) # pending handshakes are only ever popped, never re-read
+    shared_secrets = build_session_store(SESSION_STORE, 'secret', SESSION_TTL, SESSION_MAX_ENTRIES, AES_KEY, SESSION_STORE_URL,
+                                         cache_ttl=float(os.environ.get('SESSION_CACHE_TTL_SECONDS', 2)))
+
+encodings_store = EncodingsStore()
+# Uploaded registration videos, one directory per job, until face_worker.py has processed them
+VIDEOS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'videos')
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', 50 * 1024 * 1024))
+MAX_MATCH_PROBES = int(os.environ.get('MAX_MATCH_PROBES', 64))
+MAX_MATCH_TOP_K = 10
+# Approximate matching for large stores: FACE_INDEX_NPROBE=0 keeps brute force
+encodings_cache = EncodingsCache(encodings_store,
+                                 ann_nprobe=int(os.environ.get('FACE_INDEX_NPROBE', 0)),
+                                 ann_nlist=int(os.environ.get('FACE_INDEX_NLIST', 0)) or None,
+                                 ann_min_rows=int(os.environ.get('FACE_INDEX_MIN_ROWS', 10000)))
+
+# Blocking work runs on these instead of the event loop: liboqs, file I/O and numpy on threads, face
+# detection on processes (dlib holds the GIL). Registrations beyond VISION_MAX_QUEUE get 503.
+io_executor = BoundedExecutor('io', int(os.environ.get('IO_THREADS', 8)))
+vision_executor = BoundedExecutor('vision', int(os.environ.get('VISION_PROCESSES', 1)), processes=True,
+                                  max_queue=int(os.environ.get('VISION_MAX_QUEUE', 8)), initializer=load_models)
+
+encryption_helper = EncryptionHelper(
+    pool_low_watermark=int(os.environ.get('KEM_POOL_LOW_WATERMARK', 8)),
+    pool_high_watermark=int(os.environ.get('KEM_POOL_HIGH_WATERMARK', 32)),
+    kem_session_ttl=KEM_SESSION_TTL,
+    session_ttl=SESSION_TTL,
+    max_sessions=SESSION_MAX_ENTRIES,
+    kem_sessions=kem_sessions,
+    shared_secrets=shared_secrets
+)
 
 
 class RegisterDeviceRequest(BaseModel):
@@ -97,6 +122,7 @@ class KEMCompleteRequest(BaseModel):
 class FaceRegistrationRequest(BaseModel):
     mac_address: str
     video: UploadFile
+    replace: bool = False # replace the user's encodings instead of adding to them
 
     class Config(ConfigDict):
         arbitrary_types_allowed = True
@@ -112,6 +138,13 @@ class CredentialsRequest(BaseModel):
 class DeleteDeviceRequest(BaseModel):
     mac_address: str
 
+class FaceMatchRequest(BaseModel):
+    encodings: Union[list[list[float]], str, bytes] # packed (see encodings_codec) unless format is 'f64'
+    format: str = 'f64'
+    scales: Optional[Union[str, bytes]] = None
+    tolerance: float = DEFAULT_TOLERANCE
+    top_k: int = 1
+
 async def generate_totp(mac_address: str ,transaction: AsyncSession) -> int:
     query = select(Device.secret, Device.totp_timestamp).where(Device.mac_address == mac_address)
     result = await transaction.execute(query)
@@ -160,17 +193,51 @@ async def fetch_username(mac_address: str, transaction: AsyncSession) -> str:
     username = result.scalar_one_or_none()
     return username
 
+def wants_binary(request: Request) -> bool:
+    accept = request.headers.get('accept', '*/*')
+    if BINARY_MEDIA_TYPE in accept:
+        return True
+    # Clients that send a binary envelope get one back unless they explicitly ask for something else
+    return request.content_type[0] == BINARY_MEDIA_TYPE and accept.strip() == '*/*'
+
+async def read_encrypted(request: Request) -> tuple[str, dict]:
+    '''
+    Reads an encrypted request body, either a JSON EncryptedMessageRequest or a binary EncryptedEnvelope
+    (BINARY_MEDIA_TYPE). Returns the client_id and the decrypted payload.
+    '''
+
+    if request.content_type[0] == BINARY_MEDIA_TYPE:
+        try:
+            return encryption_helper.decrypt_envelope(await request.body())
+        except msgspec.DecodeError:
+            raise HTTPException(status_code=400, detail='Malformed encrypted envelope')
+
+    try:
+        data = EncryptedMessageRequest(**(await request.json()))
+    except (ValidationError, TypeError):
+        raise HTTPException(status_code=400, detail='Malformed encrypted message')
+    return data.client_id, encryption_helper.decrypt_msg(data)
+
+def encrypted_response(request: Request, data: dict, client_id: str) -> Union[Response, dict]:
+    '''
+    Encrypts the response payload in the format the client negotiated: a binary envelope if it accepts
+    BINARY_MEDIA_TYPE (or sent one without an Accept header), otherwise the JSON/base64 format.
+    '''
+
+    if wants_binary(request):
+        return Response(
+            content=encryption_helper.encrypt_envelope(data, client_id),
+            media_type=BINARY_MEDIA_TYPE,
+            status_code=request.route_handler.status_code
+        )
+    return encryption_helper.encrypt_msg(data, client_id)
+
 @get('/')
 async def home() -> dict:
     return {'status': 'success'}
 
-@post('/register')
-async def register_device(data: EncryptedMessageRequest, transaction: AsyncSession) -> dict:
-    if not data.client_id:
-        raise HTTPException(status_code=400, detail='client_id parameter is required')
-    client_id = data.client_id
-    decrypted_data = encryption_helper.decrypt_msg(data)
-    validated_data = RegisterDeviceRequest(**decrypted_data)
+async def register_device_op(payload: dict, transaction: AsyncSession) -> dict:
+    validated_data = RegisterDeviceRequest(**payload)
 
     query = select(Device).where(Device.mac_address == validated_data.mac_address.strip())
     result = await transaction.execute(query)
@@ -179,7 +246,7 @@ async def register_device(data: EncryptedMessageRequest, transaction: AsyncSessi
     if existing_device:
         raise HTTPException(status_code=409, detail='Device already registered')
     
-    (nonce_b64, ciphertext_b64) = aesgcm_encrypt(validated_data.password, AES_KEY)
+    (nonce_b64, ciphertext_b64) = aesgcm_encrypt_with(DB_CIPHER, validated_data.password)
     device = Device(
         mac_address=validated_data.mac_address.strip(),
         username=validated_data.username,
@@ -192,34 +259,22 @@ async def register_device(data: EncryptedMessageRequest, transaction: AsyncSessi
         transaction.add(device)
     except:
         raise HTTPException(status_code=400, detail='Device already registered')
-    return encryption_helper.encrypt_msg({'status_code': 201, 'status': 'success'}, client_id)
-
-@get('/devices/all-mac-addresses')
-async def get_all_mac_addresses(request: Request, transaction: AsyncSession) -> dict:
-    client_id = request.query_params.get('client_id')
-    if not client_id:
-        raise HTTPException(status_code=400, detail='client_id query parameter is required')
+    return {'status_code': 201, 'status': 'success'}
 
+async def get_all_mac_addresses_op(payload: dict, transaction: AsyncSession) -> dict:
     query = select(Device.mac_address)
     result = await transaction.execute(query)
     mac_addresses = result.scalars().all()
-    return encryption_helper.encrypt_msg({"mac_addresses": mac_addresses}, client_id)
+    return {"mac_addresses": mac_addresses}
 
-@get('/devices/{mac_address:str}/username')
-async def get_username(request: Request, mac_address: str, transaction: AsyncSession) -> dict:
-    client_id = request.query_params.get('client_id')
-    if not client_id:
-        raise HTTPException(status_code=400, detail='client_id query parameter is required')
-    
-    username = await fetch_username(mac_address, transaction)
+async def get_username_op(payload: dict, transaction: AsyncSession) -> dict:
+    username = await fetch_username(payload['mac_address'], transaction)
     if not username:
         raise HTTPException(status_code=404, detail='Device not found')
-    return encryption_helper.encrypt_msg({'username': username}, client_id)
+    return {'username': username}
 
-@put('/devices/credentials') 
-async def get_credentials(data: EncryptedMessageRequest, transaction: AsyncSession) -> dict:    
-    decrypted_data = encryption_helper.decrypt_msg(data)
-    validated_data = CredentialsRequest(**decrypted_data)
+async def get_credentials_op(payload: dict, transaction: AsyncSession) -> dict:
+    validated_data = CredentialsRequest(**payload)
     check_totp = await generate_totp(validated_data.mac_address, transaction)
     if validated_data.totp == check_totp:
         query = select(Device.username, Device.password, Device.nonce).where(Device.mac_address == validated_data.mac_address)
@@ -230,25 +285,16 @@ async def get_credentials(data: EncryptedMessageRequest, transaction: AsyncSessi
             raise HTTPException(status_code=404, detail="Device not found.")
 
         username, ciphertext, nonce = credentials
-        password = aesgcm_decrypt(nonce, ciphertext, AES_KEY)
+        password = aesgcm_decrypt_with(DB_CIPHER, nonce, ciphertext)
 
-        credential_data = {'username': username, 'password': password}
-        encrypted_data = encryption_helper.encrypt_msg(credential_data, data.client_id)
-        return encrypted_data
+        return {'username': username, 'password': password}
     else:
         print("Generated:", check_totp)
         print("Received TOTP:", validated_data.totp)
         raise HTTPException(status_code=500, detail='TOTP does not match')
 
-
-@post('/preferences/update')
-async def update_json_preferences(data: EncryptedMessageRequest, transaction: AsyncSession) -> dict:
-    client_id = data.client_id
-    if not client_id:
-        raise HTTPException(status_code=400, detail='client_id query parameter is required')
-
-    decrypted_data = encryption_helper.decrypt_msg(data)
-    validated_data = UpdateJSONPreferencesRequest(**decrypted_data)
+async def update_preferences_op(payload: dict, transaction: AsyncSession) -> dict:
+    validated_data = UpdateJSONPreferencesRequest(**payload)
 
     query = select(Device).where(Device.username == validated_data.username)
     result = await transaction.execute(query)
@@ -259,55 +305,211 @@ async def update_json_preferences(data: EncryptedMessageRequest, transaction: As
 
     try:
         device.preferences = validated_data.preferences
-        await transaction.commit()
-        return encryption_helper.encrypt_msg({'preferences': validated_data.preferences}, client_id)
+        await transaction.flush() # committed with the surrounding transaction
+        return {'preferences': validated_data.preferences}
     except Exception as e:
         raise HTTPException(status_code=500, detail='Failed to update preferences')
 
-@get('/preferences/{username:str}')
-async def get_json_preferences(request: Request, username: str, transaction: AsyncSession) -> dict:
-    client_id = request.query_params.get('client_id')
-    if not client_id:
-        raise HTTPException(status_code=400, detail='client_id query parameter is required')
-    
-    query = select(Device.preferences).where(Device.username == username)
+async def get_preferences_op(payload: dict, transaction: AsyncSession) -> dict:
+    query = select(Device.preferences).where(Device.username == payload['username'])
     result = await transaction.execute(query)
     preferences = result.scalar_one_or_none()
 
     if not preferences:
         raise HTTPException(status_code=404, detail='Username not found')
-    
+    return {'preferences': preferences}
+
+async def delete_device_op(payload: dict, transaction: AsyncSession) -> dict:
+    validated_data = DeleteDeviceRequest(**payload)
+
+    query = select(Device).where(Device.mac_address == validated_data.mac_address.strip())
+    result = await transaction.execute(query)
+    device = result.scalar_one_or_none()
+
+    if not device:
+        raise HTTPException(status_code=404, detail="Device not found")
+
+    await transaction.delete(device)
+    return {'status': 'success'}
+
+async def match_faces_op(payload: dict, transaction: AsyncSession) -> dict:
+    # A single probe may be sent as a flat list
+    if isinstance(payload.get('encodings'), list) and payload['encodings'] and not isinstance(payload['encodings'][0], list):
+        payload = payload | {'encodings': [payload['encodings']]}
+    validated_data = FaceMatchRequest(**payload)
+    if validated_data.format == 'f64':
+        if isinstance(validated_data.encodings, (str, bytes)):
+            raise HTTPException(status_code=400, detail='Packed encodings require a format')
+        if any(len(encoding) != ENCODING_DIM for encoding in validated_data.encodings):
+            raise HTTPException(status_code=400, detail=f'Encodings must have {ENCODING_DIM} dimensions')
     try:
-        return encryption_helper.encrypt_msg({'preferences': preferences},client_id)
-    except Exception as e:
-       raise HTTPException(status_code=500, detail='Preferences are not a valid JSON')
+        probes = decode_matrix(validated_data.encodings, validated_data.format, ENCODING_DIM, validated_data.scales)
+    except EncodingFormatError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not 1 <= len(probes) <= MAX_MATCH_PROBES:
+        raise HTTPException(status_code=400, detail=f'Between 1 and {MAX_MATCH_PROBES} encodings are allowed per request')
+    if not 1 <= validated_data.top_k <= MAX_MATCH_TOP_K:
+        raise HTTPException(status_code=400, detail=f'top_k must be between 1 and {MAX_MATCH_TOP_K}')
+
+    matches = await io_executor.run(lambda: encodings_cache.matcher().match(probes, validated_data.tolerance, validated_data.top_k))
+    return {'matches': matches}
+
+# Operations that can be combined in a single /batch request, with the same semantics as their endpoints
+BATCH_OPERATIONS = {
+    'register': register_device_op,
+    'get_all_mac_addresses': get_all_mac_addresses_op,
+    'get_username': get_username_op,
+    'get_credentials': get_credentials_op,
+    'update_preferences': update_preferences_op,
+    'get_preferences': get_preferences_op,
+    'delete_device': delete_device_op,
+    'match_faces': match_faces_op
+}
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', 32))
 
-@get('/encodings')
-async def get_encodings(request: Request) -> dict:
+@post('/register')
+async def register_device(request: Request, transaction: AsyncSession) -> Union[Response, dict]:
+    client_id, decrypted_data = await read_encrypted(request)
+    if not client_id:
+        raise HTTPException(status_code=400, detail='client_id parameter is required')
+    return encrypted_response(request, await register_device_op(decrypted_data, transaction), client_id)
+
+@get('/devices/all-mac-addresses')
+async def get_all_mac_addresses(request: Request, transaction: AsyncSession) -> Union[Response, dict]:
+    client_id = request.query_params.get('client_id')
+    if not client_id:
+        raise HTTPException(status_code=400, detail='client_id query parameter is required')
+
+    return encrypted_response(request, await get_all_mac_addresses_op({}, transaction), client_id)
+
+@get('/devices/{mac_address:str}/username')
+async def get_username(request: Request, mac_address: str, transaction: AsyncSession) -> Union[Response, dict]:
     client_id = request.query_params.get('client_id')
     if not client_id:
         raise HTTPException(status_code=400, detail='client_id query parameter is required')
     
-    pickle_file_path = "encodings.pickle"
-    if not os.path.exists(pickle_file_path):
-        return encryption_helper.encrypt_msg({}, client_id)
+    return encrypted_response(request, await get_username_op({'mac_address': mac_address}, transaction), client_id)
 
-    with open(pickle_file_path, 'rb') as f:
-        data = pickle.load(f)
+@put('/devices/credentials') 
+async def get_credentials(request: Request, transaction: AsyncSession) -> Union[Response, dict]:
+    client_id, decrypted_data = await read_encrypted(request)
+    return encrypted_response(request, await get_credentials_op(decrypted_data, transaction), client_id)
 
-    def convert_to_serializable(obj):
-        if isinstance(obj, np.ndarray):
-            return obj.tolist()
-        elif isinstance(obj, dict):
-            return {k: convert_to_serializable(v) for k, v in obj.items()}
-        elif isinstance(obj, list):
-            return [convert_to_serializable(i) for i in obj]
-        else:
-            return obj
 
-    serializable_data = convert_to_serializable(data)
+@post('/preferences/update')
+async def update_json_preferences(request: Request, transaction: AsyncSession) -> Union[Response, dict]:
+    client_id, decrypted_data = await read_encrypted(request)
+    if not client_id:
+        raise HTTPException(status_code=400, detail='client_id query parameter is required')
+
+    return encrypted_response(request, await update_preferences_op(decrypted_data, transaction), client_id)
 
-    return encryption_helper.encrypt_msg(serializable_data, client_id)
+@get('/preferences/{username:str}')
+async def get_json_preferences(request: Request, username: str, transaction: AsyncSession) -> Union[Response, dict]:
+    client_id = request.query_params.get('client_id')
+    if not client_id:
+        raise HTTPException(status_code=400, detail='client_id query parameter is required')
+    
+    preferences_data = await get_preferences_op({'username': username}, transaction)
+    try:
+        return encrypted_response(request, preferences_data, client_id)
+    except Exception as e:
+       raise HTTPException(status_code=500, detail='Preferences are not a valid JSON')
+
+@post('/faces/match')
+async def match_faces(request: Request) -> Union[Response, dict]:
+    '''
+    Matches one or more encrypted 128-d probe encodings against the stored encodings. The payload is
+    {'encodings': [[...], ...], 'tolerance': 0.6, 'top_k': 1}; the response lists, for each probe, the best
+    matching usernames within tolerance with their distances.
+    '''
+
+    client_id, decrypted_data = await read_encrypted(request)
+    try:
+        result = await match_faces_op(decrypted_data, None)
+    except (ValidationError, TypeError):
+        raise HTTPException(status_code=400, detail='Invalid face match request')
+    return encrypted_response(request, result, client_id)
+
+@post('/batch')
+async def batch(request: Request, transaction: AsyncSession) -> Union[Response, dict]:
+    '''
+    Runs several operations from one encrypted request in a single transaction. The payload is
+    {'operations': [{'op': <name in BATCH_OPERATIONS>, 'args': {...}}, ...]}. Each operation runs in its
+    own savepoint, so a failing one is rolled back and reported without affecting the others.
+    '''
+
+    client_id, decrypted_data = await read_encrypted(request)
+    operations = decrypted_data.get('operations') if isinstance(decrypted_data, dict) else None
+    if not isinstance(operations, list):
+        raise HTTPException(status_code=400, detail='operations list is required')
+    if len(operations) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f'At most {MAX_BATCH_SIZE} operations are allowed per batch')
+
+    results = []
+    for operation in operations:
+        op = BATCH_OPERATIONS.get(operation.get('op')) if isinstance(operation, dict) else None
+        if op is None:
+            results.append({'status_code': 400, 'detail': 'Unknown operation'})
+            continue
+        try:
+            async with transaction.begin_nested():
+                result = await op(operation.get('args') or {}, transaction)
+            results.append({'status_code': 200, 'result': result})
+        except HTTPException as e:
+            results.append({'status_code': e.status_code, 'detail': e.detail})
+        except (ValidationError, KeyError, TypeError):
+            results.append({'status_code': 400, 'detail': 'Invalid arguments'})
+        except Exception as e:
+            logging.exception('Batch operation failed')
+            results.append({'status_code': 500, 'detail': 'Operation failed'})
+
+    return encrypted_response(request, {'results': results}, client_id)
+
+@get('/encodings')
+async def get_encodings(request: Request) -> Union[Response, dict]:
+    '''
+    Returns the face encodings. With ?since=<version> only the users removed and the rows added since that
+    version are returned (or the full set, marked 'full', if the change log does not reach back that far).
+    The weak ETag identifies the store version, so If-None-Match returns 304 without any encryption work.
+    ?format=f16 or ?format=i8 returns the encodings packed and quantized (see encodings_codec).
+    '''
+
+    client_id = request.query_params.get('client_id')
+    if not client_id:
+        raise HTTPException(status_code=400, detail='client_id query parameter is required')
+
+    since = request.query_params.get('since')
+    if since is not None:
+        try:
+            since = int(since)
+        except ValueError:
+            raise HTTPException(status_code=400, detail='since must be an integer version')
+    fmt = request.query_params.get('format', 'f64')
+    if fmt not in ENCODING_FORMATS:
+        raise HTTPException(status_code=400, detail=f'format must be one of {", ".join(ENCODING_FORMATS)}')
+
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match:
+        # Checking the version may reload the store (index read, segment concatenation)
+        etag = f'W/"encodings-{await io_executor.run(encodings_cache.version)}"'
+        if etag in [tag.strip() for tag in if_none_match.split(',')]:
+            return Response(content=b'', status_code=304, headers={'ETag': etag})
+
+    # Full sets are serialized once per change to the store, only the encryption is per request
+    binary = wants_binary(request)
+
+    def serialize_and_encrypt() -> tuple[int, Union[bytes, dict]]:
+        version, plaintext = encodings_cache.serialized(binary=binary, since=since, fmt=fmt)
+        if binary:
+            return version, encryption_helper.encrypt_serialized_envelope(plaintext, client_id)
+        return version, encryption_helper.encrypt_serialized_msg(plaintext, client_id)
+
+    version, content = await io_executor.run(serialize_and_encrypt)
+    headers = {'ETag': f'W/"encodings-{version}"', 'Vary': 'Accept'}
+    if binary:
+        return Response(content=content, media_type=BINARY_MEDIA_TYPE, headers=headers)
+    return Response(content=content, headers=headers)
 
 class KEMInitiateRequest(BaseModel):
     client_id: str
@@ -318,61 +520,156 @@ class KEMCompleteRequest(BaseModel):
 
 @post('/kem/initiate')
 async def kem_initiate(data: KEMInitiateRequest) -> dict:
-    return encryption_helper.kem_initiate(data)
+    return await io_executor.run(encryption_helper.kem_initiate, data)
 
 @post('/kem/complete')
 async def kem_complete(data: KEMCompleteRequest) -> dict:
-    return encryption_helper.kem_complete(data)
+    return await io_executor.run(encryption_helper.kem_complete, data)
+
+@get('/stats')
+async def get_stats() -> dict:
+    return encryption_helper.stats() | {
+        'encodings_cache': encodings_cache.stats() | {'compactions': encodings_store.compactions},
+        'executors': {executor.name: executor.stats() for executor in (io_executor, vision_executor)}
+    }
+
+async def find_face_registration(transaction: AsyncSession, username: str, idempotency_key: str = None,
+                                 content_hash: str = None, replace: bool = False) -> Optional[FaceRegistrationJob]:
+    '''
+    Returns the job an upload repeats, if any: the user's job with the same Idempotency-Key header, or the
+    user's latest job if it had the same content and replace flag. Failed jobs are never repeated, so they
+    can be retried.
+    '''
+
+    not_failed = FaceRegistrationJob.username == username, FaceRegistrationJob.status != JOB_FAILED
+    if idempotency_key:
+        return await transaction.scalar(
+            select(FaceRegistrationJob).where(*not_failed, FaceRegistrationJob.idempotency_key == idempotency_key).limit(1)
+        )
+    # Only the latest job, so uploading an older video again still registers it
+    latest = await transaction.scalar(
+        select(FaceRegistrationJob).where(*not_failed).order_by(FaceRegistrationJob.queued_at.desc()).limit(1)
+    )
+    if latest is None or latest.content_hash != content_hash or latest.replace != replace:
+        return None
+    return latest
+
+async def hash_chunks(chunks: AsyncIterator[bytes], digest) -> AsyncIterator[bytes]:
+    async for chunk in chunks:
+        digest.update(chunk)
+        yield chunk
+
+def face_registration_dict(job: FaceRegistrationJob) -> dict:
+    return {
+        'job_id': job.id,
+        'status': job.status,
+        'attempts': job.attempts,
+        'encodings': job.encodings,
+        'error': job.error
+    }
+
+@post('/register/face', status_code=202, request_max_body_size=MAX_UPLOAD_BYTES)
+async def register_face(request: Request, data: Annotated[FaceRegistrationRequest, Body(media_type=RequestEncodingType.MULTI_PART)],
+                        transaction: AsyncSession) -> dict:
+    '''
+    Saves the video and queues it for face_worker.py. Poll /register/face/{job_id} for the result.
+
+    Repeating an upload (same Idempotency-Key header, or the same video and replace flag as the user's
+    latest job) returns the earlier job instead of queueing another one.
+    '''
 
-@post('/register/face')
-async def register_face(data: Annotated[FaceRegistrationRequest, Body(media_type=RequestEncodingType.MULTI_PART)], transaction: AsyncSession) -> dict:
     mac_address = data.mac_address
     logging.info(f"Received mac_address: {mac_address}")
-    #TODO: Add check to see if face already registered
-    username = await fetch_username(mac_address, transaction) # To be used as folder name
-    script_dir = os.path.dirname(__file__)  # Get the directory of the current script
-    user_video_dir = os.path.join(script_dir, "videos", username)
-    video_path = os.path.join(user_video_dir, 'video.webm')
+    username = await fetch_username(mac_address, transaction)
+    if not username:
+        raise HTTPException(status_code=404, detail='Device not found')
+
+    idempotency_key = request.headers.get('idempotency-key')
+    if idempotency_key and (job := await find_face_registration(transaction, username, idempotency_key)):
+        return {'status': job.status, 'job_id': job.id}
 
-    os.makedirs(os.path.dirname(video_path), exist_ok=True)
+    job_id = uuid.uuid4().hex
+    job_dir = os.path.join(VIDEOS_DIR, job_id)
+    video_path = os.path.join(job_dir, 'video.webm')
+    os.makedirs(job_dir, exist_ok=True)
 
     chunk_size = 1024 * 1024 # 1MB
-    with open(video_path, 'wb') as video_file:
+    digest = hashlib.sha256()
+    video_file = await io_executor.run(open, video_path, 'wb')
+    try:
         while True:
             chunk = await data.video.read(chunk_size)
             if not chunk:
                 break
-            video_file.write(chunk)
-
-    # need to convert to mp4 cuz webm isn't fully saved/processed by the time we need to extract frames
-    mp4_path = os.path.join(user_video_dir, "video.mp4")
-    convert_to_mp4(video_path, mp4_path)
-    extracted_frames = split_frames(mp4_path, user_video_dir)
-    # retrain model on new frames, might need to async it
-    train_model(extracted_frames, username)
-
-    # delete folder
-    if os.path.exists(user_video_dir):
-        shutil.rmtree(user_video_dir, ignore_errors=True)
-        logging.info(f"Deleted folder: {user_video_dir}")
-
-    return {'status': 'success'}
+            digest.update(chunk)
+            await io_executor.run(video_file.write, chunk)
+    finally:
+        await io_executor.run(video_file.close)
+
+    content_hash = digest.hexdigest()
+    if job := await find_face_registration(transaction, username, content_hash=content_hash, replace=data.replace):
+        logging.info(f"Video already uploaded by {username} in job {job.id}")
+        await io_executor.run(shutil.rmtree, job_dir)
+        return {'status': job.status, 'job_id': job.id}
+
+    now = time.time()
+    transaction.add(FaceRegistrationJob(id=job_id, username=username, video_path=video_path, replace=data.replace,
+                                        idempotency_key=idempotency_key, content_hash=content_hash, status=JOB_QUEUED,
+                                        attempts=0, queued_at=now, changed_at=now))
+    return {'status': JOB_QUEUED, 'job_id': job_id}
+
+@post('/register/face/stream', request_max_body_size=MAX_UPLOAD_BYTES)
+async def register_face_stream(request: Request, transaction: AsyncSession) -> dict:
+    '''
+    Registers a face from the raw video body (?mac_address=...&replace=1), piping it into ffmpeg as it arrives.
+
+    Nothing is written to disk and there is no job queue: the response is sent once the encodings are
+    stored, with the same fields as GET /register/face/{job_id}. Repeated uploads (see register_face)
+    return the earlier job without encoding the frames again.
+    '''
+
+    mac_address = request.query_params.get('mac_address')
+    if not mac_address:
+        raise HTTPException(status_code=400, detail='mac_address query parameter is required')
+    username = await fetch_username(mac_address, transaction)
+    if not username:
+        raise HTTPException(status_code=404, detail='Device not found')
+    replace = request.query_params.get('replace', '').lower() in ('1', 'true')
+
+    idempotency_key = request.headers.get('idempotency-key')
+    if idempotency_key and (job := await find_face_registration(transaction, username, idempotency_key)):
+        return face_registration_dict(job)
+
+    # The whole body has been hashed once the frames are decoded, before anything is encoded
+    digest = hashlib.sha256()
+    frames = await stream_frames(hash_chunks(request.stream(), digest))
+    content_hash = digest.hexdigest()
+    if job := await find_face_registration(transaction, username, content_hash=content_hash, replace=replace):
+        logging.info(f"Video already uploaded by {username} in job {job.id}")
+        return face_registration_dict(job)
+
+    # Face encoding is CPU bound, keep it off the event loop (and out of this process)
+    encodings = await vision_executor.run(frame_encodings, frames)
+    encodings = await io_executor.run(save_encodings, encodings, username, encodings_store, replace)
+
+    now = time.time()
+    job = FaceRegistrationJob(id=uuid.uuid4().hex, username=username, video_path='', replace=replace,
+                              idempotency_key=idempotency_key, content_hash=content_hash, status=JOB_DONE, attempts=1,
+                              worker=f'web:{os.getpid()}', encodings=encodings, queued_at=now, changed_at=now)
+    transaction.add(job)
+    return face_registration_dict(job)
+
+@get('/register/face/{job_id:str}')
+async def get_face_registration(job_id: str, transaction: AsyncSession) -> dict:
+    job = await transaction.get(FaceRegistrationJob, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail='Job not found')
+    return face_registration_dict(job)
 
 @delete("/devices/delete", status_code=202)
-async def delete_device(data: EncryptedMessageRequest, transaction: AsyncSession) -> dict:
-    decrypted_data = encryption_helper.decrypt_msg(data)
-    validated_data = DeleteDeviceRequest(**decrypted_data)
-
-    query = select(Device).where(Device.mac_address == validated_data.mac_address.strip())
-    result = await transaction.execute(query)
-    device = result.scalar_one_or_none()
-
-    if not device:
-        raise HTTPException(status_code=404, detail="Device not found")
-
-    await transaction.delete(device)
-
-    return {'status': 'success'}
+async def delete_device(request: Request, transaction: AsyncSession) -> dict:
+    _, decrypted_data = await read_encrypted(request)
+    return await delete_device_op(decrypted_data, transaction)
 
 TEST = False
 if TEST:
@@ -386,6 +683,20 @@ db_config = SQLAlchemyAsyncConfig(
     create_all=True,
     before_send_handler=autocommit_before_send_handler
 )
+# Created here rather than by the plugin so the listeners below apply to the engine the plugin uses
+db_config.engine_instance = db_config.get_engine()
+
+# The sqlite3 driver only starts a transaction before DML and never before SAVEPOINT, so a batch
+# operation's savepoint could be the outermost transaction and be committed on release. Turn the
+# driver's transaction handling off and emit BEGIN ourselves (see SQLAlchemy's SQLite dialect docs).
+@event.listens_for(db_config.engine_instance.sync_engine, 'connect')
+def disable_driver_transactions(dbapi_connection, connection_record) -> None:
+    dbapi_connection.isolation_level = None
+
+@event.listens_for(db_config.engine_instance.sync_engine, 'begin')
+def begin_transaction(connection) -> None:
+    connection.exec_driver_sql('BEGIN')
+
 sqlalchemy_plugin = SQLAlchemyPlugin(config=db_config)
 
 cors_config = CORSConfig(
@@ -402,13 +713,20 @@ app = Litestar(
         get_username,
         get_credentials,
         register_face,
+        register_face_stream,
+        get_face_registration,
         get_json_preferences,
         update_json_preferences,
         kem_complete,
         kem_initiate,
         get_encodings,
-        delete_device
+        delete_device,
+        batch,
+        match_faces,
+        get_stats
     ],
+    on_startup=[encryption_helper.start, encodings_store.start_compactor],
+    on_shutdown=[encryption_helper.stop, encodings_store.stop_compactor, io_executor.shutdown, vision_executor.shutdown],
     dependencies={'transaction': provide_transaction},
     plugins=[sqlalchemy_plugin],
     cors_config=cors_config,
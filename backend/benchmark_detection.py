@@ -0,0 +1,82 @@
+'''
+Compares face detection at several scales on registration videos or images:
+
+    python benchmark_detection.py video.webm frame.jpg ... --scales 1 0.75 0.5 0.25 [--username alice]
+
+For each scale it reports the detection time per frame, the share of frames with a face, how far the
+encodings move from the full-resolution ones (the match distance cost of downscaling), and, with
+--username, how many frames still match that user in the encodings store within the match tolerance.
+Use it to pick FACE_DETECT_SCALE for face_worker.py.
+'''
+
+import argparse
+import time
+import numpy as np
+import face_recognition
+from encodings_cache import EncodingsCache
+from encodings_store import EncodingsStore
+from face_encoder import detect_faces, read_frame
+from face_matching import DEFAULT_TOLERANCE
+from video_encoding import iter_frames
+
+
+def load_frames(paths: list[str]) -> list[np.ndarray]:
+    frames = []
+    for path in paths:
+        if path.lower().endswith(('.jpg', '.jpeg', '.png')):
+            frame = read_frame(path)
+            if frame is not None:
+                frames.append(frame)
+        else:
+            frames.extend(iter_frames(path))
+    return frames
+
+
+def benchmark(frames: list[np.ndarray], scales: list[float], username: str = None, tolerance: float = DEFAULT_TOLERANCE) -> list[dict]:
+    matcher = EncodingsCache(EncodingsStore()).matcher() if username else None
+
+    reference = None
+    results = []
+    for scale in sorted(scales, reverse=True):
+        detect_seconds, encodings = 0.0, []
+        for frame in frames:
+            start = time.perf_counter()
+            boxes, _ = detect_faces(frame, scale=scale)
+            detect_seconds += time.perf_counter() - start
+            # The largest face, encoded from the original pixels
+            box = max(boxes, key=lambda b: (b[2] - b[0]) * (b[1] - b[3])) if boxes else None
+            encodings.append(face_recognition.face_encodings(frame, [box])[0] if box else None)
+        if reference is None:
+            reference = encodings # at the largest scale
+
+        drift = [np.linalg.norm(e - r) for e, r in zip(encodings, reference) if e is not None and r is not None]
+        result = {
+            'scale': scale,
+            'detect_ms_per_frame': 1000 * detect_seconds / max(1, len(frames)),
+            'frames_with_face': sum(e is not None for e in encodings) / max(1, len(frames)),
+            'mean_distance_to_full_scale': float(np.mean(drift)) if drift else None,
+            'max_distance_to_full_scale': float(np.max(drift)) if drift else None
+        }
+        if matcher is not None:
+            found = [e for e in encodings if e is not None]
+            matches = matcher.match(np.asarray(found), tolerance, 1) if found else []
+            result['frames_matching_user'] = sum(bool(m) and m[0]['username'] == username for m in matches) / max(1, len(frames))
+        results.append(result)
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Compare face detection time and accuracy across detection scales.')
+    parser.add_argument('inputs', nargs='+', help='videos (sampled like a registration) or images')
+    parser.add_argument('--scales', nargs='+', type=float, default=[1.0, 0.75, 0.5, 0.25])
+    parser.add_argument('--username', help='check the frames still match this user in the encodings store')
+    args = parser.parse_args()
+
+    frames = load_frames(args.inputs)
+    print(f"{len(frames)} frames of {frames[0].shape[1]}x{frames[0].shape[0]}" if frames else "no frames")
+    for result in benchmark(frames, args.scales, args.username):
+        print('  '.join(f'{key}={value:.4g}' if isinstance(value, float) else f'{key}={value}' for key, value in result.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+import threading
+import msgspec
+import numpy as np
+from encodings_store import EncodingsStore
+from face_matching import FaceMatcher
+from ann_index import IVFIndex
+from encodings_codec import encode_matrix
+
+# Number of noisy copies of stored rows used to measure the ANN index's recall after each build
+RECALL_PROBES = 64
+
+
+class EncodingsCache():
+    '''
+    Process-level cache of the face encodings store and its serialized plaintext.
+
+    The store is only reloaded when its index was rewritten, by this process or any other (registrations,
+    face_worker.py, compaction). The matrix stays memory-mapped, and the JSON and msgpack serializations
+    are built at most once per change, so serving /encodings only costs the per-client encryption.
+
+    If ann_nprobe is set, matching goes through an IVF index once the store has at least ann_min_rows rows.
+    The index is kept across reloads: rows appended to the same data file are added to it incrementally,
+    and it is only retrained after a rewrite or once the store has doubled since the last training.
+
+    _lock only guards the reload itself. Serializing and building the index run outside it (on a snapshot
+    of the store) so version() and stats() never wait for them.
+    '''
+
+    def __init__(self, store: EncodingsStore, ann_nprobe: int = None, ann_nlist: int = None, ann_min_rows: int = 10000):
+        self.store = store
+        self.ann_nprobe = ann_nprobe
+        self.ann_nlist = ann_nlist
+        self.ann_min_rows = ann_min_rows
+        self._ann = None
+        self._ann_data_file = None
+        self.reloads = 0
+        self.hits = 0
+        self._lock = threading.Lock()
+        # Only one thread builds the matcher (and the ANN index) and one serializes at a time
+        self._matcher_lock = threading.Lock()
+        self._serialize_lock = threading.Lock()
+        self.current_version = None # published after each reload, read without the lock
+        self._signature = None
+        self._index = None
+        self._matrix = None
+        self._names = []
+        self._serialized = {}
+        self._matcher = None
+
+    def _refresh(self) -> None:
+        signature = self.store.signature()
+        if signature is not None and signature == self._signature:
+            self.hits += 1
+            return
+
+        index = self.store.index()
+        if signature is None:
+            signature = self.store.signature()
+        self._index = index
+        self._matrix, self._names = self.store.load(index)
+        self._serialized = {}
+        self._matcher = None
+        self._signature = signature
+        self.reloads += 1
+        self.current_version = index.get('version', 0)
+
+    def load(self) -> tuple[np.ndarray, list[str]]:
+        '''
+        Returns the (memory-mapped) encodings matrix and the username of each row.
+        '''
+
+        with self._lock:
+            self._refresh()
+            return self._matrix, self._names
+
+    def matcher(self) -> FaceMatcher:
+        '''
+        Returns a FaceMatcher over the current encodings, built once per change to the store.
+        '''
+
+        with self._matcher_lock:
+            with self._lock:
+                self._refresh()
+                if self._matcher is not None:
+                    return self._matcher
+                reload, index, matrix, names = self.reloads, self._index, self._matrix, self._names
+            # Building the ANN index (k-means) can take seconds
+            matcher = FaceMatcher(matrix, names, self._ann_index(index, matrix), self.ann_nprobe)
+            with self._lock:
+                if self.reloads == reload:
+                    self._matcher = matcher
+            return matcher
+
+    def _ann_index(self, index: dict, matrix: np.ndarray) -> IVFIndex:
+        # Called with _matcher_lock held
+        if not self.ann_nprobe or len(matrix) < self.ann_min_rows:
+            self._ann = None
+            return None
+
+        ann = self._ann
+        if (ann is not None and self._ann_data_file == index['data_file']
+                and ann.rows <= len(matrix) <= 2 * ann.trained_rows):
+            # Older matchers keep the index they were built with, so extend a copy of it
+            self._ann = ann.extended(matrix[ann.rows:])
+            return self._ann
+
+        ann = IVFIndex(nlist=self.ann_nlist, nprobe=self.ann_nprobe)
+        ann.build(matrix)
+        rng = np.random.default_rng(0)
+        sample = np.asarray(matrix[rng.choice(len(matrix), size=min(RECALL_PROBES, len(matrix)), replace=False)])
+        recall = ann.measure_recall(matrix, sample + rng.normal(scale=0.02, size=sample.shape))
+        print(f"[INFO] built ANN index over {ann.rows} encodings: {recall}")
+        self._ann = ann
+        self._ann_data_file = index['data_file']
+        return ann
+
+    def version(self) -> int:
+        '''
+        Returns the store version. If another thread is reloading the store, returns the version published
+        by the last reload instead of waiting.
+        '''
+
+        if self._lock.acquire(blocking=self.current_version is None):
+            try:
+                self._refresh()
+            finally:
+                self._lock.release()
+        return self.current_version
+
+    def serialized(self, binary: bool = False, since: int = None, fmt: str = 'f64') -> tuple[int, bytes]:
+        '''
+        Returns the store version and the encodings serialized as msgpack if binary, otherwise as JSON.
+        The encodings are packed in the given format (see encodings_codec.encode_matrix); for packed
+        formats the payload also carries 'format' and 'dim', and 'scales' next to each 'encodings' for i8.
+
+        Without since (or if since is too old for the change log) this is the full set,
+        {'version', 'full': True, 'encodings': [...], 'names': [...]}. Otherwise it is the delta
+        {'version', 'since', 'removed': [names], 'added': {'encodings': [...], 'names': [...]}}: clients drop
+        every row of the removed users and then append the added rows.
+        '''
+
+        encoder = msgspec.msgpack if binary else msgspec.json
+        key = ('msgpack' if binary else 'json', fmt)
+        with self._lock:
+            self._refresh()
+            reload, index, matrix, names = self.reloads, self._index, self._matrix, self._names
+            version = index.get('version', 0)
+            delta = self.store.changes_since(index, since) if since is not None else None
+            if delta is None and key in self._serialized:
+                return version, self._serialized[key]
+        packed = {} if fmt == 'f64' else {'format': fmt, 'dim': matrix.shape[1]}
+
+        if delta is None:
+            with self._serialize_lock:
+                with self._lock: # another thread may have just serialized the same snapshot
+                    if self.reloads == reload and key in self._serialized:
+                        return version, self._serialized[key]
+                data = {'version': version, 'full': True, 'names': names} | packed
+                plaintext = encoder.encode(data | encode_matrix(matrix, fmt, binary))
+                with self._lock:
+                    if self.reloads == reload:
+                        self._serialized[key] = plaintext
+                return version, plaintext
+
+        removed, added = delta
+        added_rows = [matrix[offset:offset + count] for _, offset, count in added]
+        added_matrix = np.concatenate(added_rows) if added_rows else matrix[:0]
+        data = {
+            'version': version,
+            'since': since,
+            'removed': removed,
+            'added': {'names': [name for name, _, count in added for _ in range(count)]} | encode_matrix(added_matrix, fmt, binary)
+        } | packed
+        return version, encoder.encode(data)
+
+    def stats(self) -> dict:
+        # Read without the lock, so /stats never waits for a reload
+        ann = self._ann
+        return {
+            'reloads': self.reloads,
+            'hits': self.hits,
+            'version': self.current_version,
+            'rows': len(self._names),
+            'ann_index': ann.stats() if ann is not None else None
+        }
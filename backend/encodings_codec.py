@@ -0,0 +1,70 @@
+import base64
+import numpy as np
+
+# Query parameter values for the encodings representation; 'f64' is the plain list of floats
+ENCODING_FORMATS = ('f64', 'f16', 'i8')
+
+
+class EncodingFormatError(ValueError):
+    pass
+
+
+def encode_matrix(matrix: np.ndarray, fmt: str, binary: bool = False) -> dict:
+    '''
+    Packs a (N, dim) matrix in the given format.
+
+    'f64' is {'encodings': [[...], ...]}. 'f16' is {'encodings': <little-endian float16 rows>} and 'i8' is
+    {'encodings': <int8 rows>, 'scales': <little-endian float32, one per row>}, where
+    row = int8 row * scale with the scale chosen so the row's largest component maps to 127. The packed
+    fields are raw bytes for msgpack (binary) and base64 strings for JSON.
+    '''
+
+    matrix = np.asarray(matrix)
+    if fmt == 'f64':
+        return {'encodings': matrix.tolist()}
+    if fmt == 'f16':
+        fields = {'encodings': matrix.astype('<f2').tobytes()}
+    elif fmt == 'i8':
+        scales = (np.abs(matrix).max(axis=1) / 127.0).astype('<f4') if len(matrix) else np.empty(0, dtype='<f4')
+        safe = np.where(scales > 0, scales, 1.0)[:, None]
+        quantized = np.clip(np.rint(matrix / safe), -127, 127).astype(np.int8)
+        fields = {'encodings': quantized.tobytes(), 'scales': scales.tobytes()}
+    else:
+        raise EncodingFormatError(f'format must be one of {", ".join(ENCODING_FORMATS)}')
+    if not binary:
+        fields = {key: base64.b64encode(value).decode('ascii') for key, value in fields.items()}
+    return fields
+
+
+def decode_matrix(encodings, fmt: str, dim: int, scales=None) -> np.ndarray:
+    '''
+    Inverse of encode_matrix: returns a float64 (N, dim) matrix. Packed fields may be bytes or base64.
+    '''
+
+    if fmt == 'f64':
+        return np.asarray(encodings, dtype=np.float64).reshape(-1, dim)
+
+    def unpack(value, dtype):
+        try:
+            raw = value if isinstance(value, bytes) else base64.b64decode(value, validate=True)
+            return np.frombuffer(raw, dtype=dtype)
+        except (TypeError, ValueError) as e:
+            raise EncodingFormatError(f'invalid packed {fmt} encodings') from e
+
+    if fmt == 'f16':
+        values = unpack(encodings, '<f2')
+    elif fmt == 'i8':
+        values = unpack(encodings, np.int8)
+    else:
+        raise EncodingFormatError(f'format must be one of {", ".join(ENCODING_FORMATS)}')
+    if values.size % dim:
+        raise EncodingFormatError(f'packed {fmt} encodings are not a whole number of {dim}-d rows')
+    matrix = values.astype(np.float64).reshape(-1, dim)
+    if fmt == 'i8':
+        if scales is None:
+            raise EncodingFormatError('i8 encodings require scales')
+        scales = unpack(scales, '<f4')
+        if len(scales) != len(matrix):
+            raise EncodingFormatError('i8 encodings need one scale per row')
+        matrix *= scales[:, None]
+    return matrix
@@ -0,0 +1,375 @@
+import fcntl
+import json
+import logging
+import os
+import pickle
+import struct
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+import numpy as np
+
+ENCODINGS_DIR = "encodings"
+LEGACY_ENCODINGS_FILE = "encodings.pickle"
+ENCODING_DIM = 128
+
+# The .npy header is written with a fixed size so the row count can be updated in place on append
+HEADER_SIZE = 128
+# Number of changes kept in the index for delta sync; older clients get a full resync
+MAX_CHANGES = 1000
+# Appends compact inline once this many segments are waiting, even without a background compactor
+MAX_SEGMENTS = 16
+COMPACT_INTERVAL = 10
+# Files no longer referenced by the index are only deleted after this long, so readers that loaded the
+# previous index can still open them
+GARBAGE_GRACE_SECONDS = 60
+
+
+def _write_npy_header(f, count: int, dim: int, dtype: np.dtype) -> None:
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%d, %d), }" % (dtype.str, count, dim)
+    header_len = HEADER_SIZE - 10
+    header = header.ljust(header_len - 1) + '\n'
+    f.seek(0)
+    f.write(b'\x93NUMPY\x01\x00' + struct.pack('<H', header_len) + header.encode('latin1'))
+
+
+class EncodingsStore():
+    '''
+    Face encodings stored as one contiguous row-major .npy matrix, a log of append segments and a small
+    JSON index.
+
+    The index records the data file, the row count and the owner of each run of rows as
+    [username, offset, count]. Every change bumps a monotonic version and is recorded in the index's
+    change log, so clients can fetch only what changed since the version they hold.
+
+    Appends write the new rows to a new segment file (write, then rename) and then add it to the index, so
+    they cost O(new rows). Compaction (in the background, or inline once MAX_SEGMENTS pile up) copies the
+    segments onto the end of the main matrix, past the rows the index covers, and then drops them from
+    the index. Rewrites (anything that removes rows) go to a new data file. Every writer, in any process,
+    holds an exclusive lock on encodings/.lock, and the index is always swapped atomically, so readers
+    never block and never see a partial write. Readers memory-map the matrix, so loading is O(1) and memory
+    use does not grow with the number of users.
+    '''
+
+    def __init__(self, directory: str = ENCODINGS_DIR, dim: int = ENCODING_DIM, dtype: str = 'float64',
+                 legacy_pickle: str = LEGACY_ENCODINGS_FILE, compact_interval: float = COMPACT_INTERVAL):
+        self.directory = directory
+        self.compact_interval = compact_interval
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.legacy_pickle = legacy_pickle
+        self.index_path = os.path.join(directory, 'index.json')
+        self.lock_path = os.path.join(directory, '.lock')
+        self.compactions = 0
+        self._lock = threading.Lock()
+        self._compactor = None
+        self._stop_compactor = threading.Event()
+
+    @contextmanager
+    def _write_lock(self):
+        # flock excludes writers in other processes, the threading lock other threads of this one
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock, open(self.lock_path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read_index(self) -> dict:
+        try:
+            with open(self.index_path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _write_index(self, index: dict) -> None:
+        tmp_path = f'{self.index_path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.index_path)
+
+    def index(self) -> dict:
+        '''
+        Returns the current index, creating the store (and migrating the legacy pickle) on first use.
+        '''
+
+        index = self._read_index()
+        if index is None:
+            with self._write_lock():
+                index = self._read_index()
+                if index is None:
+                    index = self._create()
+        return index
+
+    def signature(self):
+        '''
+        Changes whenever the store is modified, by this or any other process.
+        '''
+
+        try:
+            st = os.stat(self.index_path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def load(self, index: dict = None) -> tuple[np.ndarray, list[str]]:
+        '''
+        Returns a read-only memory-mapped (count, dim) matrix and the username of every row.
+        '''
+
+        index = index or self.index()
+        data_count = index.get('data_count', index['count'])
+        if data_count == 0:
+            matrix = np.empty((0, index['dim']), dtype=np.dtype(index['dtype']))
+        else:
+            matrix = np.memmap(os.path.join(self.directory, index['data_file']), dtype=np.dtype(index['dtype']),
+                               mode='r', offset=HEADER_SIZE, shape=(data_count, index['dim']))
+        segments = [np.load(os.path.join(self.directory, segment['file']), mmap_mode='r') for segment in index.get('segments', [])]
+        if segments:
+            # Only until the next compaction, which is what keeps this copy small and rare
+            matrix = np.concatenate([matrix, *segments])
+        names = []
+        for username, _, rows in index['users']:
+            names.extend([username] * rows)
+        return matrix, names
+
+    def _new_data_file(self, matrix: np.ndarray) -> str:
+        data_file = f'encodings-{uuid.uuid4().hex}.npy'
+        with open(os.path.join(self.directory, data_file), 'wb') as f:
+            _write_npy_header(f, len(matrix), self.dim, self.dtype)
+            f.write(np.ascontiguousarray(matrix, dtype=self.dtype).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        return data_file
+
+    def _rewrite(self, index: dict, names: list[str], matrix: np.ndarray, changes: list = None, new_changes: list = ()) -> dict:
+        users = []
+        for offset, username in enumerate(names):
+            if users and users[-1][0] == username:
+                users[-1][2] += 1
+            else:
+                users.append([username, offset, 1])
+        new_index = dict(index or {}, data_file=self._new_data_file(matrix), dim=self.dim, dtype=self.dtype.str,
+                         count=len(names), data_count=len(names), segments=[], users=users)
+        if changes is None:
+            # Row offsets change, so clients holding an earlier version need a full resync
+            version = (index or {}).get('version', 0) + 1
+            new_index.update(version=version, base_version=version, changes=[])
+        else:
+            new_index['changes'] = changes
+            for change in new_changes:
+                self._record_change(new_index, change)
+        self._write_index(new_index)
+        self._collect_garbage(new_index)
+        return new_index
+
+    def _create(self) -> dict:
+        names, encodings = [], []
+        if self.legacy_pickle and os.path.exists(self.legacy_pickle) and os.path.getsize(self.legacy_pickle) > 0:
+            with open(self.legacy_pickle, 'rb') as f:
+                data = pickle.load(f)
+            names, encodings = list(data['names']), data['encodings']
+            print(f"[INFO] migrated {len(names)} encodings from '{self.legacy_pickle}'")
+        matrix = np.asarray(encodings, dtype=self.dtype).reshape(-1, self.dim)
+        return self._rewrite(None, names, matrix)
+
+    def _write_segment(self, rows: np.ndarray) -> str:
+        segment = f'segment-{uuid.uuid4().hex}.npy'
+        path = os.path.join(self.directory, segment)
+        with open(f'{path}.tmp', 'wb') as f:
+            np.save(f, rows)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f'{path}.tmp', path)
+        return segment
+
+    def append(self, username: str, encodings: list) -> dict:
+        '''
+        Appends encodings for a user as a new segment, touching only the new rows. Returns the new index.
+        '''
+
+        rows = np.asarray(encodings, dtype=self.dtype).reshape(-1, self.dim)
+        index = self.index() # creates the store on first use
+        if len(rows) == 0:
+            return index
+        # Written before taking the lock; it only becomes visible once the index references it
+        segment = self._write_segment(rows)
+        with self._write_lock():
+            index = self._read_index()
+            count = index['count']
+            index.setdefault('data_count', count)
+            index.setdefault('segments', []).append({'file': segment, 'offset': count, 'count': len(rows)})
+
+            users = index['users']
+            if users and users[-1][0] == username:
+                users[-1][2] += len(rows)
+            else:
+                users.append([username, count, len(rows)])
+            index['count'] = count + len(rows)
+            self._record_change(index, {'added': [username, count, len(rows)]})
+            self._write_index(index)
+            if len(index['segments']) >= MAX_SEGMENTS:
+                index = self._compact(index)
+            return index
+
+    def _compact(self, index: dict) -> dict:
+        segments = index.get('segments', [])
+        if not segments:
+            return index
+        data_count = index.get('data_count', index['count'] - sum(segment['count'] for segment in segments))
+        row_size = index['dim'] * self.dtype.itemsize
+        with open(os.path.join(self.directory, index['data_file']), 'r+b') as f:
+            # Past the rows the index covers, so readers of the current index are unaffected
+            f.seek(HEADER_SIZE + data_count * row_size)
+            for segment in segments:
+                rows = np.load(os.path.join(self.directory, segment['file']))
+                f.write(np.ascontiguousarray(rows, dtype=self.dtype).tobytes())
+                data_count += len(rows)
+            f.truncate()
+            _write_npy_header(f, data_count, self.dim, self.dtype)
+            f.flush()
+            os.fsync(f.fileno())
+
+        index = dict(index, data_count=data_count, segments=[])
+        self._write_index(index)
+        self.compactions += 1
+        self._collect_garbage(index)
+        return index
+
+    def compact(self) -> dict:
+        '''
+        Folds the append segments into the main matrix. The version is unchanged, as the rows are the same.
+        '''
+
+        index = self.index()
+        if not index.get('segments'):
+            return index
+        with self._write_lock():
+            return self._compact(self._read_index())
+
+    def _collect_garbage(self, index: dict) -> None:
+        referenced = {index['data_file'], 'index.json', '.lock'} | {segment['file'] for segment in index.get('segments', [])}
+        now = time.time()
+        for name in os.listdir(self.directory):
+            if name in referenced or not name.startswith(('encodings-', 'segment-', 'index.json.')):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if now - os.path.getmtime(path) > GARBAGE_GRACE_SECONDS:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def start_compactor(self) -> None:
+        if self._compactor is not None:
+            return
+        self._stop_compactor.clear()
+
+        def run():
+            while not self._stop_compactor.wait(self.compact_interval):
+                try:
+                    self.compact()
+                except Exception:
+                    logging.exception("Encodings store compaction failed")
+
+        self._compactor = threading.Thread(target=run, name='encodings-compactor', daemon=True)
+        self._compactor.start()
+
+    def stop_compactor(self) -> None:
+        if self._compactor is None:
+            return
+        self._stop_compactor.set()
+        self._compactor.join()
+        self._compactor = None
+
+    def _record_change(self, index: dict, change: dict) -> None:
+        index['version'] = index.get('version', 0) + 1
+        changes = index.setdefault('changes', [])
+        changes.append(dict(change, version=index['version']))
+        if len(changes) > MAX_CHANGES:
+            dropped = changes[:len(changes) - MAX_CHANGES]
+            del changes[:len(dropped)]
+            index['base_version'] = dropped[-1]['version']
+
+    def changes_since(self, index: dict, since: int):
+        '''
+        Returns (removed usernames, added [username, offset, count] runs) between version since and the
+        index's version, or None if the change log no longer reaches back that far.
+        '''
+
+        if since < index.get('base_version', 0) or since > index.get('version', 0):
+            return None
+        removed, added = [], []
+        for change in index.get('changes', []):
+            if change['version'] <= since:
+                continue
+            if 'removed' in change:
+                # Clients drop every row of a removed user, including rows added earlier in this delta
+                added = [run for run in added if run[0] not in change['removed']]
+                removed.extend(name for name in change['removed'] if name not in removed)
+            if 'added' in change:
+                added.append(change['added'])
+        return removed, added
+
+    def replace(self, username: str, encodings: list, merge=None) -> dict:
+        '''
+        Replaces a user's rows with the given encodings, or with merge(existing rows, encodings) if merge is
+        given. Returns the new index.
+
+        This rewrites the data file, but the change is recorded as a removal plus an addition (with the
+        offsets of earlier changes remapped), so clients can still sync it as a delta.
+        '''
+
+        rows = np.asarray(encodings, dtype=self.dtype).reshape(-1, self.dim)
+        self.index()
+        with self._write_lock():
+            index = self._read_index()
+            matrix, names = self.load(index)
+            keep = np.asarray([name != username for name in names], dtype=bool)
+            if merge is not None:
+                rows = np.asarray(merge(np.asarray(matrix[~keep]), rows), dtype=self.dtype).reshape(-1, self.dim)
+            removed_runs = [(offset, count) for name, offset, count in index['users'] if name == username]
+
+            def remap(offset: int) -> int:
+                return offset - sum(count for start, count in removed_runs if start < offset)
+
+            changes = []
+            for change in index.get('changes', []):
+                if 'added' in change and change['added'][0] != username:
+                    name, offset, count = change['added']
+                    change = dict(change, added=[name, remap(offset), count])
+                changes.append(change)
+
+            kept_names = [name for name in names if name != username]
+            new_changes = [{'removed': [username]}]
+            if len(rows):
+                new_changes.append({'added': [username, len(kept_names), len(rows)]})
+            new_matrix = np.concatenate([np.asarray(matrix)[keep], rows])
+            return self._rewrite(index, kept_names + [username] * len(rows), new_matrix, changes, new_changes)
+
+    def rewrite(self, names: list[str], matrix: np.ndarray) -> dict:
+        '''
+        Replaces the whole store with the given rows. Returns the new index.
+        '''
+
+        self.index()
+        with self._write_lock():
+            return self._rewrite(self._read_index(), list(names), np.asarray(matrix).reshape(-1, self.dim))
+
+    def rewrite_with(self, transform) -> dict:
+        '''
+        Replaces the whole store with transform(matrix, names), which returns the new (names, matrix).
+        Returns the new index.
+
+        The store stays locked from reading the rows to writing the result, so no append is lost in between.
+        '''
+
+        self.index()
+        with self._write_lock():
+            index = self._read_index()
+            names, matrix = transform(*self.load(index))
+            return self._rewrite(index, list(names), np.asarray(matrix).reshape(-1, self.dim))
@@ -1,10 +1,14 @@
 from pydantic import BaseModel
 import oqs
 import base64
-from aesgcm_encryption import aesgcm_encrypt, aesgcm_decrypt
-import json
+from aesgcm_encryption import aesgcm_encrypt_bytes, aesgcm_decrypt_bytes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+import msgspec
 from litestar.exceptions import HTTPException
 import numpy as np
+from cryptography.exceptions import InvalidTag
+from kem_pool import KEMKeypairPool
+from session_store import SessionStore, MemorySessionStore
 
 
 class KEMInitiateRequest(BaseModel):
@@ -22,37 +26,146 @@ class EncryptedMessageRequest(BaseModel):
     ciphertext_b64: str
 
 
+BINARY_MEDIA_TYPE = 'application/msgpack'
+
+
+class EncryptedEnvelope(msgspec.Struct):
+    '''
+    Binary counterpart of EncryptedMessageRequest, sent as a msgpack body with raw bytes instead of base64.
+    The ciphertext holds the msgpack-encoded payload.
+    '''
+    client_id: str
+    nonce: bytes
+    ciphertext: bytes
+
+
 class EncryptionHelper():
-    def __init__(self):
+    def __init__(self, pool_low_watermark: int = 8, pool_high_watermark: int = 32,
+                 kem_session_ttl: float = 60, session_ttl: float = 86400, max_sessions: int = 10000,
+                 kem_sessions: SessionStore = None, shared_secrets: SessionStore = None):
+        '''
+        kem_sessions and shared_secrets default to in-process stores. Passing shared stores lets several
+        worker processes serve the same clients; pending KEM sessions are then kept as exported secret
+        keys rather than native handles so that any worker can complete the handshake.
+        '''
+
         self.KEM_ALGORITHM = 'ML-KEM-512'
-        self.kem_sessions = {}
-        self.shared_secrets = {}
+        # Abandoned handshakes are freed by the sweeper, completed ones by kem_complete
+        if kem_sessions is None:
+            kem_sessions = MemorySessionStore(ttl=kem_session_ttl, max_entries=max_sessions,
+                                              on_evict=lambda client_id, server_kem: server_kem.free())
+        if shared_secrets is None:
+            shared_secrets = MemorySessionStore(ttl=session_ttl, max_entries=max_sessions,
+                                                on_evict=lambda client_id, shared_secret: self.ciphers.pop(client_id))
+        self.kem_sessions = kem_sessions
+        self.shared_secrets = shared_secrets
+        # client_id -> (shared_secret, AESGCM) so the AES key schedule is only set up once per secret
+        self.ciphers = MemorySessionStore(ttl=session_ttl, max_entries=max_sessions)
+        self.keypair_pool = KEMKeypairPool(self.KEM_ALGORITHM, pool_low_watermark, pool_high_watermark)
+
+    def start(self) -> None:
+        self.keypair_pool.start()
+        self.kem_sessions.start()
+        self.shared_secrets.start()
+        self.ciphers.start()
+
+    def stop(self) -> None:
+        self.keypair_pool.stop()
+        self.kem_sessions.stop()
+        self.shared_secrets.stop()
+        self.ciphers.stop()
+
+    def stats(self) -> dict:
+        return {
+            'kem_pool': self.keypair_pool.stats(),
+            'kem_sessions': self.kem_sessions.stats(),
+            'shared_secrets': self.shared_secrets.stats(),
+            'ciphers': self.ciphers.stats()
+        }
+
+    def get_cipher(self, client_id: str) -> AESGCM:
+        '''
+        Returns the cached AESGCM cipher for the client, rebuilding it if the client's shared secret has changed.
+        '''
+
+        shared_secret = self.shared_secrets.get(client_id)
+        if not shared_secret:
+            raise ValueError("Shared secret not found for client_id")
+        entry = self.ciphers.get(client_id)
+        if entry is None or entry[0] != shared_secret:
+            entry = (shared_secret, AESGCM(shared_secret))
+            self.ciphers[client_id] = entry
+        return entry[1]
+
+    def _decrypt(self, client_id: str, nonce: bytes, ciphertext: bytes) -> bytes:
+        cipher = self.get_cipher(client_id)
+        try:
+            return aesgcm_decrypt_bytes(cipher, nonce, ciphertext)
+        except InvalidTag:
+            # The client may have completed a new handshake on another worker since we cached its secret
+            self.shared_secrets.invalidate(client_id)
+            refreshed_cipher = self.get_cipher(client_id)
+            if refreshed_cipher is cipher:
+                raise
+            return aesgcm_decrypt_bytes(refreshed_cipher, nonce, ciphertext)
 
     def decrypt_msg(self, data: EncryptedMessageRequest) -> dict:
         try:
-            shared_secret = self.shared_secrets.get(data.client_id)
-            if not shared_secret:
-                raise ValueError("Shared secret not found for client_id")
-            plaintext = aesgcm_decrypt(data.nonce_b64, data.ciphertext_b64, shared_secret)
-            return json.loads(plaintext)
+            plaintext = self._decrypt(data.client_id, base64.b64decode(data.nonce_b64), base64.b64decode(data.ciphertext_b64))
+            return msgspec.json.decode(plaintext)
         except Exception as e:
             raise RuntimeError(f"Failed to decrypt message: {e}")
 
     def encrypt_msg(self, data: dict, client_id: str) -> dict:
-        shared_secret = self.shared_secrets.get(client_id)
-        if not shared_secret:
-            raise ValueError("Shared secret not found for client_id")
-        nonce_b64, ciphertext_b64 = aesgcm_encrypt(json.dumps(data), shared_secret)
-        return {'nonce_b64': nonce_b64, 'ciphertext_b64': ciphertext_b64}
+        return self.encrypt_serialized_msg(msgspec.json.encode(data), client_id)
+
+    def encrypt_serialized_msg(self, plaintext: bytes, client_id: str) -> dict:
+        '''
+        Same as encrypt_msg, for a payload that has already been serialized to JSON.
+        '''
+
+        nonce, ciphertext = aesgcm_encrypt_bytes(self.get_cipher(client_id), plaintext)
+        return {'nonce_b64': base64.b64encode(nonce).decode(), 'ciphertext_b64': base64.b64encode(ciphertext).decode()}
+
+    def decrypt_envelope(self, body: bytes) -> tuple[str, dict]:
+        '''
+        Decrypts a binary EncryptedEnvelope. Returns the client_id and the decoded payload.
+        '''
+
+        envelope = msgspec.msgpack.decode(body, type=EncryptedEnvelope)
+        try:
+            plaintext = self._decrypt(envelope.client_id, envelope.nonce, envelope.ciphertext)
+            return envelope.client_id, msgspec.msgpack.decode(plaintext)
+        except Exception as e:
+            raise RuntimeError(f"Failed to decrypt message: {e}")
+
+    def encrypt_envelope(self, data: dict, client_id: str) -> bytes:
+        '''
+        Encrypts the payload into a binary EncryptedEnvelope, ready to be sent as a BINARY_MEDIA_TYPE body.
+        '''
+
+        return self.encrypt_serialized_envelope(msgspec.msgpack.encode(data), client_id)
+
+    def encrypt_serialized_envelope(self, plaintext: bytes, client_id: str) -> bytes:
+        '''
+        Same as encrypt_envelope, for a payload that has already been serialized to msgpack.
+        '''
+
+        nonce, ciphertext = aesgcm_encrypt_bytes(self.get_cipher(client_id), plaintext)
+        return msgspec.msgpack.encode(EncryptedEnvelope(client_id=client_id, nonce=nonce, ciphertext=ciphertext))
     
     def kem_initiate(self, data: KEMInitiateRequest) -> dict:
         '''
-        Initiate key exchange session. The server generates a KEM key pair and returns the public key.
+        Initiate key exchange session. The server takes a pre-generated KEM key pair from the pool and returns the public key.
         '''
 
-        server_kem = oqs.KeyEncapsulation(self.KEM_ALGORITHM)
-        self.kem_sessions[data.client_id] = server_kem
-        public_key = server_kem.generate_keypair()
+        server_kem, public_key = self.keypair_pool.acquire()
+        if isinstance(self.kem_sessions, MemorySessionStore):
+            self.kem_sessions[data.client_id] = server_kem # frees any earlier pending session for this client
+        else:
+            # Native handles cannot be shared between processes, so only the (wrapped) secret key is stored
+            self.kem_sessions[data.client_id] = server_kem.export_secret_key()
+            server_kem.free()
         public_key_b64 = base64.b64encode(public_key).decode()
         return {'public_key_b64': public_key_b64}
 
@@ -64,6 +177,8 @@ class EncryptionHelper():
         server_kem = self.kem_sessions.pop(data.client_id, None)
         if not server_kem:
             raise HTTPException(status_code=401, detail='Client not recognised, please initiate a new key exchange session.')
+        if isinstance(server_kem, bytes):
+            server_kem = oqs.KeyEncapsulation(self.KEM_ALGORITHM, server_kem)
         
         try:
             ciphertext = base64.b64decode(data.ciphertext_b64)
@@ -76,4 +191,5 @@ class EncryptionHelper():
             server_kem.free()
         
         self.shared_secrets[data.client_id] = shared_secret
+        self.ciphers.pop(data.client_id)
         return {'status': 'success'}
\ No newline at end of file
@@ -0,0 +1,74 @@
+import asyncio
+import functools
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from litestar.exceptions import HTTPException
+
+
+class BoundedExecutor():
+    '''
+    Runs blocking calls for the event loop on a pool of at most max_workers threads (or processes).
+
+    Handlers await run() instead of calling liboqs, numpy, dlib or the file system directly, so the event
+    loop keeps serving cheap requests while that work runs. Calls beyond max_workers wait in the pool's
+    queue; with max_queue set, calls that would make the queue longer are rejected with 503 instead, so
+    an overload fails fast rather than piling up. stats() reports the queue depth.
+
+    The pool is started on first use and shut down by shutdown(), after which the next call starts a new one.
+    '''
+
+    def __init__(self, name: str, max_workers: int, processes: bool = False, max_queue: int = 0, initializer=None):
+        self.name = name
+        self.max_workers = max(1, max_workers)
+        self.processes = processes
+        self.max_queue = max_queue
+        self.initializer = initializer
+        self.in_flight = 0
+        self.max_queued = 0
+        self.completed = 0
+        self.rejected = 0
+        self._executor = None
+
+    def _start(self) -> Executor:
+        if self._executor is None:
+            if self.processes:
+                # spawn rather than fork: the server holds database connections and dlib isn't fork-safe
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context('spawn'),
+                                                     initializer=self.initializer)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=self.name,
+                                                    initializer=self.initializer)
+        return self._executor
+
+    @property
+    def queued(self) -> int:
+        # The pool runs calls in submission order, so everything past the first max_workers is waiting
+        return max(0, self.in_flight - self.max_workers)
+
+    async def run(self, fn, *args, **kwargs):
+        if self.max_queue and self.queued >= self.max_queue:
+            self.rejected += 1
+            raise HTTPException(status_code=503, detail='Server busy, try again later')
+        self.in_flight += 1
+        self.max_queued = max(self.max_queued, self.queued)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._start(), functools.partial(fn, *args, **kwargs))
+        finally:
+            self.in_flight -= 1
+            self.completed += 1
+
+    def stats(self) -> dict:
+        return {
+            'workers': self.max_workers,
+            'running': min(self.in_flight, self.max_workers),
+            'queued': self.queued,
+            'max_queued': self.max_queued,
+            'max_queue': self.max_queue,
+            'completed': self.completed,
+            'rejected': self.rejected
+        }
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
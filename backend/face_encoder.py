@@ -0,0 +1,265 @@
+import itertools
+import logging
+import multiprocessing
+import os
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional, Union
+import cv2
+import numpy as np
+
+face_recognition = None
+
+# Around a previously found face, the region searched first is the box grown by this fraction on each side
+TRACK_PADDING = 0.5
+# Faces are detected on the image resized by this factor; encodings always use the original pixels
+DETECT_SCALE = 1.0
+# Frames failing these cheap checks (on a small grayscale copy) are skipped before face detection:
+# variance of the Laplacian (blur) and mean brightness (0-255)
+MIN_SHARPNESS = 15.0
+MIN_BRIGHTNESS = 40
+MAX_BRIGHTNESS = 220
+# A new encoding counts towards a budget if it is at least DISTINCT_DISTANCE from every kept encoding and
+# within CONSISTENT_DISTANCE of their mean (i.e. the same person)
+DISTINCT_DISTANCE = 0.05
+CONSISTENT_DISTANCE = 0.5
+
+
+def load_models() -> None:
+    # Importing face_recognition loads dlib's detector and encoder models, so do it once per process
+    global face_recognition
+    if face_recognition is None:
+        import face_recognition as module
+        face_recognition = module
+
+
+def read_frame(frame: Union[np.ndarray, str]) -> Optional[np.ndarray]:
+    if not isinstance(frame, str):
+        return frame
+    image = cv2.imread(frame)
+    if image is None:
+        print(f"[WARNING] could not read image {frame}, skipping.")
+        return None
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+def _locate(rgb: np.ndarray, scale: float) -> list[tuple]:
+    if scale == 1:
+        return face_recognition.face_locations(np.ascontiguousarray(rgb), model="hog")
+    height, width = rgb.shape[:2]
+    small = cv2.resize(rgb, (max(1, round(width * scale)), max(1, round(height * scale))), interpolation=cv2.INTER_AREA)
+    # Map the boxes back to full resolution
+    return [
+        (max(0, int(top / scale)), min(width, int(round(right / scale))), min(height, int(round(bottom / scale))), max(0, int(left / scale)))
+        for top, right, bottom, left in face_recognition.face_locations(small, model="hog")
+    ]
+
+
+def detect_faces(rgb: np.ndarray, hint: tuple = None, padding: float = TRACK_PADDING, scale: float = DETECT_SCALE) -> tuple[list[tuple], int]:
+    '''
+    Returns the HOG face boxes (top, right, bottom, left) in an RGB image and the number of pixels scanned.
+
+    With a hint (a box where the face was in a nearby frame), only the padded region around it is searched,
+    and the whole image only if no face is found there. With scale < 1 the detector runs on a downsampled
+    copy, which costs about scale^2 as much, and the boxes are mapped back to full resolution.
+    '''
+
+    load_models()
+    height, width = rgb.shape[:2]
+    scanned = 0
+    if hint is not None:
+        top, right, bottom, left = hint
+        pad_y, pad_x = int((bottom - top) * padding), int((right - left) * padding)
+        y0, y1 = max(0, top - pad_y), min(height, bottom + pad_y)
+        x0, x1 = max(0, left - pad_x), min(width, right + pad_x)
+        if y1 > y0 and x1 > x0:
+            boxes = _locate(rgb[y0:y1, x0:x1], scale)
+            scanned += round((y1 - y0) * (x1 - x0) * scale * scale)
+            if boxes:
+                return [(t + y0, r + x0, b + y0, l + x0) for t, r, b, l in boxes], scanned
+    return _locate(rgb, scale), scanned + round(height * width * scale * scale)
+
+
+def encode_tracked(frame: Union[np.ndarray, str], hint: tuple = None, scale: float = DETECT_SCALE) -> tuple[list[np.ndarray], tuple, int]:
+    '''
+    Returns the encodings of the faces in a frame, the largest face's box (None if there is no face) to use
+    as the hint for the next frame, and the number of pixels the detector scanned.
+    '''
+
+    rgb = read_frame(frame)
+    if rgb is None:
+        return [], hint, 0
+    boxes, scanned = detect_faces(rgb, hint, scale=scale)
+    if not boxes:
+        return [], hint, scanned
+    largest = max(boxes, key=lambda box: (box[2] - box[0]) * (box[1] - box[3]))
+    return face_recognition.face_encodings(rgb, boxes), largest, scanned
+
+
+def score_frame(rgb: np.ndarray) -> tuple[float, float]:
+    '''
+    Returns a frame's sharpness (variance of the Laplacian) and mean brightness, measured at 320px wide.
+    '''
+
+    gray = cv2.cvtColor(rgb, cv2.COLOR_RGB2GRAY)
+    if gray.shape[1] > 320:
+        gray = cv2.resize(gray, (320, max(1, round(gray.shape[0] * 320 / gray.shape[1]))), interpolation=cv2.INTER_AREA)
+    return float(cv2.Laplacian(gray, cv2.CV_64F).var()), float(gray.mean())
+
+
+def rank_frames(frames: Iterable[Union[np.ndarray, str]], min_sharpness: float = MIN_SHARPNESS,
+                min_brightness: float = MIN_BRIGHTNESS, max_brightness: float = MAX_BRIGHTNESS) -> list[np.ndarray]:
+    '''
+    Returns the frames that pass the quality checks as RGB arrays, sharpest first. If none pass, all the
+    readable frames are returned (sharpest first) rather than nothing.
+    '''
+
+    scored = []
+    for frame in frames:
+        rgb = read_frame(frame)
+        if rgb is not None:
+            scored.append((*score_frame(rgb), rgb))
+    scored.sort(key=lambda item: item[0], reverse=True)
+    passed = [rgb for sharpness, brightness, rgb in scored
+              if sharpness >= min_sharpness and min_brightness <= brightness <= max_brightness]
+    if len(passed) < len(scored):
+        print(f"[INFO] skipped {len(scored) - len(passed)} of {len(scored)} frames as too blurry, dark or bright")
+    if not passed and scored:
+        print("[WARNING] no frame passed the quality checks, using all of them")
+        return [rgb for _, _, rgb in scored]
+    return passed
+
+
+class EncodingBudget():
+    '''
+    Collects encodings until there are target distinct, consistent ones.
+
+    Encodings closer than min_distance to a kept one add nothing (near-identical frames), and encodings
+    further than max_distance from the mean of the kept ones are someone else (or a bad detection), so
+    neither counts towards the target.
+    '''
+
+    def __init__(self, target: int, min_distance: float = DISTINCT_DISTANCE, max_distance: float = CONSISTENT_DISTANCE):
+        self.target = target
+        self.min_distance = min_distance
+        self.max_distance = max_distance
+        self.kept = []
+        self.duplicates = 0
+        self.inconsistent = 0
+
+    def add(self, encodings: list[np.ndarray]) -> None:
+        for encoding in encodings:
+            encoding = np.asarray(encoding)
+            if self.kept:
+                kept = np.asarray(self.kept)
+                if np.linalg.norm(encoding - kept.mean(axis=0)) > self.max_distance:
+                    self.inconsistent += 1
+                    continue
+                if np.linalg.norm(kept - encoding, axis=1).min() < self.min_distance:
+                    self.duplicates += 1
+                    continue
+            self.kept.append(encoding)
+
+    @property
+    def done(self) -> bool:
+        return len(self.kept) >= self.target
+
+
+class FaceEncoderPool():
+    '''
+    Persistent pool of processes that detect and encode faces, one frame per task.
+
+    Each process loads the models once when it starts and is reused for every registration. Results come
+    back in frame order. If a process dies (e.g. dlib crashes on a frame), the pool is restarted and the
+    batch retried once.
+
+    With track, the first frame is searched in full and every later frame only around the face found in it
+    (see detect_faces). Frames are encoded in parallel, so they can't each follow the frame before them, but
+    a selfie clip keeps the face in nearly the same place.
+    '''
+
+    def __init__(self, processes: int = None, track: bool = True, scale: float = DETECT_SCALE):
+        self.processes = processes or os.cpu_count() or 1
+        self.track = track
+        self.scale = scale
+        self.frames = 0
+        self.scanned_pixels = 0
+        self._executor = None
+
+    def _start(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn rather than fork: the parent may hold database connections and dlib isn't fork-safe
+            self._executor = ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context('spawn'),
+                                                 initializer=load_models)
+        return self._executor
+
+    def encode(self, frames: Iterable[Union[np.ndarray, str]], budget: EncodingBudget = None) -> list[list[np.ndarray]]:
+        '''
+        Returns the encodings found in each frame (see encode_tracked), in order. Frames are submitted as the
+        iterable yields them, so encoding overlaps with decoding the rest of the video.
+
+        With a budget, frames are encoded in waves of one frame per process, each wave's encodings are
+        added to the budget, and no further waves are started once it is done. Only the frames encoded so
+        far are returned.
+        '''
+
+        if budget is None:
+            return [encodings for encodings, _, _ in self._retrying(frames)]
+
+        frames = iter(frames)
+        results = []
+        anchor = None
+        while not budget.done:
+            wave = list(itertools.islice(frames, self.processes))
+            if not wave:
+                break
+            wave_results = self._retrying(wave, anchor)
+            anchor = anchor or next((box for _, box, _ in wave_results if box is not None), None)
+            for encodings, _, _ in wave_results:
+                budget.add(encodings)
+                results.append(encodings)
+        return results
+
+    def _retrying(self, frames: Iterable, anchor: tuple = None) -> list[tuple]:
+        frames = iter(frames)
+        submitted = []
+
+        def remember():
+            # Keeps what was already taken from frames, to resubmit it if the pool breaks
+            for frame in frames:
+                submitted.append(frame)
+                yield frame
+
+        for attempt in range(2):
+            try:
+                source = remember() if attempt == 0 else itertools.chain(list(submitted), remember())
+                return self._encode(source, anchor)
+            except BrokenProcessPool:
+                logging.warning("Face encoder pool broke, restarting it")
+                self.close()
+                if attempt:
+                    raise
+
+    def _encode(self, frames: Iterator, anchor: tuple = None) -> list[tuple]:
+        executor = self._start()
+        scale = itertools.repeat(self.scale)
+        if not self.track:
+            results = list(executor.map(encode_tracked, frames, itertools.repeat(None), scale))
+        else:
+            results = []
+            if anchor is None:
+                first = next(frames, None)
+                if first is None:
+                    return []
+                results.append(executor.submit(encode_tracked, first, None, self.scale).result())
+                anchor = results[0][1]
+            results.extend(executor.map(encode_tracked, frames, itertools.repeat(anchor), scale))
+        self.frames += len(results)
+        self.scanned_pixels += sum(scanned for _, _, scanned in results)
+        return results
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,80 @@
+import numpy as np
+
+# face_recognition's default: distances above this are not considered the same person
+DEFAULT_TOLERANCE = 0.6
+
+
+class FaceMatcher():
+    '''
+    Matches probe encodings against the stored encodings with one matrix operation per batch of probes.
+
+    Squared distances are computed as |p|^2 + |e|^2 - 2 p.e, so the cost is a single (P x 128) by (128 x N)
+    product. Rows are grouped by username once, and each user's best (smallest) distance is then taken with
+    one reduceat.
+
+    With an ANN index (see ann_index.IVFIndex) each probe is only compared against the index's candidate
+    rows, and those candidates are re-ranked with exact distances.
+    '''
+
+    def __init__(self, matrix: np.ndarray, names: list[str], index=None, nprobe: int = None):
+        self.matrix = matrix
+        self.index = index
+        self.nprobe = nprobe
+        self.norms = np.einsum('ij,ij->i', matrix, matrix) if len(matrix) else np.empty(0)
+        self.usernames, name_ids = np.unique(np.asarray(names, dtype=object), return_inverse=True)
+        self.name_ids = name_ids
+        self.order = np.argsort(name_ids, kind='stable')
+        sorted_ids = name_ids[self.order]
+        self.starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]]) if len(sorted_ids) else np.empty(0, dtype=int)
+
+    def distances(self, probes: np.ndarray) -> np.ndarray:
+        '''
+        Returns the (P, N) matrix of euclidean distances between each probe and each stored encoding.
+        '''
+
+        probe_norms = np.einsum('ij,ij->i', probes, probes)
+        squared = probe_norms[:, None] + self.norms[None, :] - 2.0 * (probes @ self.matrix.T)
+        return np.sqrt(np.maximum(squared, 0.0))
+
+    def user_distances(self, probes: np.ndarray) -> np.ndarray:
+        '''
+        Returns the (P, U) matrix of each probe's best distance to each user in self.usernames.
+        '''
+
+        return np.minimum.reduceat(self.distances(probes)[:, self.order], self.starts, axis=1)
+
+    def match(self, probes: np.ndarray, tolerance: float = DEFAULT_TOLERANCE, top_k: int = 1) -> list[list[dict]]:
+        '''
+        Returns, for each probe, up to top_k {'username', 'distance'} matches within tolerance, best first.
+        '''
+
+        probes = np.asarray(probes, dtype=np.float64).reshape(-1, self.matrix.shape[1])
+        if len(self.usernames) == 0:
+            return [[] for _ in range(len(probes))]
+        if self.index is not None:
+            return [self._match_indexed(probe, tolerance, top_k) for probe in probes]
+
+        user_distances = self.user_distances(probes)
+        k = min(top_k, user_distances.shape[1])
+        candidates = np.argpartition(user_distances, k - 1, axis=1)[:, :k]
+        results = []
+        for probe_distances, probe_candidates in zip(user_distances, candidates):
+            ranked = probe_candidates[np.argsort(probe_distances[probe_candidates])]
+            results.append([
+                {'username': str(self.usernames[user]), 'distance': float(probe_distances[user])}
+                for user in ranked if probe_distances[user] <= tolerance
+            ])
+        return results
+
+    def _match_indexed(self, probe: np.ndarray, tolerance: float, top_k: int) -> list[dict]:
+        ids = self.index.candidates(probe, self.nprobe)
+        squared = probe @ probe + self.norms[ids] - 2.0 * (np.asarray(self.matrix[ids]) @ probe)
+        distances = np.sqrt(np.maximum(squared, 0.0))
+        ranked = np.argsort(distances, kind='stable')
+        # The first occurrence of each user in distance order is that user's best row
+        _, first = np.unique(self.name_ids[ids[ranked]], return_index=True)
+        best = np.sort(first)[:top_k]
+        return [
+            {'username': str(self.usernames[self.name_ids[ids[ranked[i]]]]), 'distance': float(distances[ranked[i]])}
+            for i in best if distances[ranked[i]] <= tolerance
+        ]
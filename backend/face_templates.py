@@ -0,0 +1,54 @@
+import os
+import numpy as np
+from encodings_store import EncodingsStore
+
+# Encodings closer than this to an already kept template are treated as duplicates
+DEFAULT_DEDUPE_DISTANCE = 0.1
+
+
+def compact_templates(encodings: np.ndarray, max_templates: int, dedupe_distance: float = DEFAULT_DEDUPE_DISTANCE) -> np.ndarray:
+    '''
+    Collapses one user's encodings into at most max_templates representative rows.
+
+    The first template is the centroid. Further templates are picked by farthest-point sampling: the
+    encoding farthest from every template kept so far is added next, so the outliers (other angles,
+    lighting, glasses, ...) are kept first, and picking stops once every remaining encoding is within
+    dedupe_distance of a template.
+    '''
+
+    encodings = np.asarray(encodings, dtype=np.float64)
+    if len(encodings) == 0 or max_templates <= 0:
+        return encodings[:0]
+
+    templates = [encodings.mean(axis=0)]
+    nearest = np.linalg.norm(encodings - templates[0], axis=1)
+    while len(templates) < max_templates:
+        farthest = int(np.argmax(nearest))
+        if nearest[farthest] <= dedupe_distance:
+            break
+        templates.append(encodings[farthest])
+        nearest = np.minimum(nearest, np.linalg.norm(encodings - encodings[farthest], axis=1))
+    return np.stack(templates)
+
+
+def compact_store(store: EncodingsStore, max_templates: int, dedupe_distance: float = DEFAULT_DEDUPE_DISTANCE) -> dict:
+    '''
+    Rewrites the whole store with every user compacted. Returns the new index.
+    '''
+
+    def compact(matrix: np.ndarray, names: list[str]) -> tuple[list[str], np.ndarray]:
+        matrix = np.asarray(matrix)
+        usernames = list(dict.fromkeys(names))
+        name_array = np.asarray(names, dtype=object)
+        compacted = [compact_templates(matrix[name_array == username], max_templates, dedupe_distance) for username in usernames]
+        new_names = [username for username, rows in zip(usernames, compacted) for _ in range(len(rows))]
+        print(f"[INFO] compacted {len(names)} encodings of {len(usernames)} users into {len(new_names)} templates")
+        return new_names, np.concatenate(compacted) if compacted else matrix[:0]
+
+    # Compacting under the store's write lock, so registrations appended meanwhile wait instead of being lost
+    return store.rewrite_with(compact)
+
+
+if __name__ == '__main__':
+    compact_store(EncodingsStore(), int(os.environ.get('FACE_TEMPLATES_MAX', 5)),
+                  float(os.environ.get('FACE_TEMPLATES_DEDUPE_DISTANCE', DEFAULT_DEDUPE_DISTANCE)))
@@ -0,0 +1,241 @@
+'''
+Processes queued face registration jobs (see POST /register/face) outside the web server.
+
+Run it next to the server, from the same directory so it shares the database and the encodings store:
+
+    python face_worker.py --concurrency 2
+
+Each worker process claims the oldest queued job, decodes the sampled frames in memory and appends the
+encodings to the store. Frames are detected and encoded in parallel on the worker's FaceEncoderPool.
+The web workers pick up the new encodings on their next request. Jobs left running by a worker that died
+are requeued after FACE_JOB_STALE_SECONDS, up to FACE_JOB_MAX_ATTEMPTS times.
+'''
+
+import argparse
+import logging
+import multiprocessing
+import os
+import shutil
+import socket
+import time
+from sqlalchemy import create_engine, select, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from models import Base, FaceRegistrationJob, JOB_QUEUED, JOB_RUNNING, JOB_DONE, JOB_FAILED
+from encodings_store import EncodingsStore
+from face_encoder import FaceEncoderPool, DETECT_SCALE
+from face_templates import DEFAULT_DEDUPE_DISTANCE
+from video_encoding import iter_frames, sample_frames
+from train_model import encode_faces, store_encodings
+
+DB_FILENAME = os.environ.get('FACE_WORKER_DB', 'db.sqlite')
+CONCURRENCY = int(os.environ.get('FACE_WORKER_CONCURRENCY', 1))
+POLL_INTERVAL = float(os.environ.get('FACE_WORKER_POLL_SECONDS', 1))
+JOB_STALE_SECONDS = float(os.environ.get('FACE_JOB_STALE_SECONDS', 900))
+JOB_MAX_ATTEMPTS = int(os.environ.get('FACE_JOB_MAX_ATTEMPTS', 3))
+# Processes detecting and encoding faces for each worker (default: the CPUs shared between the workers, as
+# far as memory allows)
+ENCODER_PROCESSES = int(os.environ.get('FACE_ENCODER_PROCESSES', 0))
+# Memory an encoder process needs: each loads dlib's models, about 100 MB for the landmark predictor alone
+ENCODER_PROCESS_MB = int(os.environ.get('FACE_ENCODER_PROCESS_MB', 300))
+# Rows kept per user after each registration (0 keeps every encoding)
+FACE_TEMPLATES_MAX = int(os.environ.get('FACE_TEMPLATES_MAX', 0))
+FACE_TEMPLATES_DEDUPE_DISTANCE = float(os.environ.get('FACE_TEMPLATES_DEDUPE_DISTANCE', DEFAULT_DEDUPE_DISTANCE))
+# Search later frames around the face found in earlier ones instead of the whole image
+FACE_TRACKING = os.environ.get('FACE_TRACKING', '1') == '1'
+# Detect faces on frames downscaled by this factor (see benchmark_detection.py to choose it)
+FACE_DETECT_SCALE = float(os.environ.get('FACE_DETECT_SCALE', DETECT_SCALE))
+# Encode the sharpest frames first and stop after this many distinct encodings of the face (0 encodes every frame)
+FACE_ENCODING_BUDGET = int(os.environ.get('FACE_ENCODING_BUDGET', 10))
+# For debugging: also save the sampled frames of each job as JPEGs in <dir>/<job id>/ and encode those
+DEBUG_FRAMES_DIR = os.environ.get('FACE_DEBUG_FRAMES_DIR')
+
+
+def available_memory() -> int:
+    '''
+    Returns the container's memory limit in bytes (cgroup v2 or v1), or the host's physical memory.
+    '''
+
+    for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        try:
+            with open(path) as f:
+                limit = f.read().strip()
+        except OSError:
+            continue
+        if limit.isdigit() and int(limit) < 1 << 60: # 'max' (or a huge v1 value) means no limit
+            return int(limit)
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def default_encoder_processes(concurrency: int) -> int:
+    concurrency = max(1, concurrency)
+    by_cpu = (os.cpu_count() or 1) // concurrency
+    by_memory = available_memory() // (ENCODER_PROCESS_MB * 1024 * 1024 * concurrency)
+    return max(1, min(by_cpu, by_memory))
+
+
+def create_db_engine(filename: str = DB_FILENAME) -> Engine:
+    # Wait for the web server's write transactions instead of failing with "database is locked"
+    engine = create_engine(f'sqlite:///{filename}', connect_args={'timeout': 30})
+    Base.metadata.create_all(engine)
+    return engine
+
+
+def claim_job(session: Session, worker: str) -> FaceRegistrationJob:
+    '''
+    Marks the oldest queued job as running for this worker and returns it, or None if the queue is empty.
+    '''
+
+    while True:
+        job_id = session.execute(
+            select(FaceRegistrationJob.id)
+            .where(FaceRegistrationJob.status == JOB_QUEUED)
+            .order_by(FaceRegistrationJob.queued_at)
+            .limit(1)
+        ).scalar_one_or_none()
+        if job_id is None:
+            return None
+
+        # Only succeeds for one worker if several saw the same job
+        result = session.execute(
+            update(FaceRegistrationJob)
+            .where(FaceRegistrationJob.id == job_id, FaceRegistrationJob.status == JOB_QUEUED)
+            .values(status=JOB_RUNNING, worker=worker, attempts=FaceRegistrationJob.attempts + 1, changed_at=time.time())
+        )
+        session.commit()
+        if result.rowcount == 1:
+            return session.get(FaceRegistrationJob, job_id, populate_existing=True)
+
+
+def requeue_stale_jobs(session: Session, stale_seconds: float = JOB_STALE_SECONDS) -> int:
+    '''
+    Requeues jobs whose worker stopped updating them, or fails them once they used up their attempts.
+    '''
+
+    stale = FaceRegistrationJob.status == JOB_RUNNING, FaceRegistrationJob.changed_at < time.time() - stale_seconds
+    failed = session.execute(
+        update(FaceRegistrationJob)
+        .where(*stale, FaceRegistrationJob.attempts >= JOB_MAX_ATTEMPTS)
+        .values(status=JOB_FAILED, error='Worker stopped while processing the job', changed_at=time.time())
+        .returning(FaceRegistrationJob.video_path)
+    ).scalars().all()
+    requeued = session.execute(
+        update(FaceRegistrationJob).where(*stale).values(status=JOB_QUEUED, changed_at=time.time())
+    ).rowcount
+    session.commit()
+    for video_path in failed:
+        remove_video(video_path)
+    if failed or requeued:
+        logging.warning(f"Requeued {requeued} and failed {len(failed)} stale face registration jobs")
+    return requeued
+
+
+def process_job(job: FaceRegistrationJob, store: EncodingsStore, pool: FaceEncoderPool = None) -> int:
+    '''
+    Runs the registration pipeline for a job. Returns the number of encodings extracted.
+    '''
+
+    if DEBUG_FRAMES_DIR:
+        frames = sample_frames(job.video_path, os.path.join(DEBUG_FRAMES_DIR, job.id))
+    else:
+        frames = iter_frames(job.video_path)
+    return encode_frames(frames, job.username, store, pool, job.replace)
+
+
+def encode_frames(frames, username: str, store: EncodingsStore, pool: FaceEncoderPool = None, replace: bool = False) -> int:
+    '''
+    Encodes the faces in the frames and stores them for the user, with the configured templates settings.
+    With replace, the user's earlier encodings are dropped.
+    '''
+
+    return save_encodings(frame_encodings(frames, pool), username, store, replace)
+
+
+def frame_encodings(frames, pool: FaceEncoderPool = None) -> list:
+    '''
+    Returns the encodings of the faces in the frames, with the configured detection settings.
+    '''
+
+    return encode_faces(frames, pool, FACE_TRACKING, FACE_DETECT_SCALE, FACE_ENCODING_BUDGET)
+
+
+def save_encodings(encodings: list, username: str, store: EncodingsStore, replace: bool = False) -> int:
+    '''
+    Stores a user's encodings with the configured templates settings. Returns how many were extracted.
+    '''
+
+    return store_encodings(encodings, username, store, FACE_TEMPLATES_MAX, FACE_TEMPLATES_DEDUPE_DISTANCE, replace)
+
+
+def finish_job(session: Session, job: FaceRegistrationJob, encodings: int = None, error: str = None) -> None:
+    job.status = JOB_FAILED if error else JOB_DONE
+    job.encodings = encodings
+    job.error = error
+    job.changed_at = time.time()
+    session.commit()
+    remove_video(job.video_path)
+
+
+def remove_video(video_path: str) -> None:
+    # The video is only kept while the job may still be retried
+    shutil.rmtree(os.path.dirname(video_path), ignore_errors=True)
+
+
+def run_worker(worker: str, filename: str = DB_FILENAME, encoder_processes: int = None) -> None:
+    engine = create_db_engine(filename)
+    store = EncodingsStore()
+    pool = FaceEncoderPool(encoder_processes, track=FACE_TRACKING, scale=FACE_DETECT_SCALE)
+    last_requeue = 0
+    logging.info(f"Face worker {worker} started with {pool.processes} encoder processes")
+    try:
+        with Session(engine, expire_on_commit=False) as session:
+            while True:
+                if time.time() - last_requeue > min(60, JOB_STALE_SECONDS):
+                    requeue_stale_jobs(session)
+                    last_requeue = time.time()
+
+                job = claim_job(session, worker)
+                if job is None:
+                    time.sleep(POLL_INTERVAL)
+                    continue
+
+                logging.info(f"Worker {worker} processing face registration job {job.id} for {job.username}")
+                try:
+                    encodings = process_job(job, store, pool)
+                except Exception as e:
+                    logging.exception(f"Face registration job {job.id} failed")
+                    finish_job(session, job, error=str(getattr(e, 'detail', None) or e))
+                else:
+                    finish_job(session, job, encodings=encodings)
+                    logging.info(f"Face detection has scanned {pool.scanned_pixels / max(1, pool.frames):.0f} pixels per frame")
+    finally:
+        pool.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Process queued face registration jobs.')
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY, help='number of worker processes')
+    parser.add_argument('--db', default=DB_FILENAME, help='SQLite database shared with the web server')
+    parser.add_argument('--encoder-processes', type=int, default=ENCODER_PROCESSES,
+                        help='face encoding processes per worker (default: CPUs / concurrency, limited by memory)')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    encoder_processes = args.encoder_processes or default_encoder_processes(args.concurrency)
+    hostname = socket.gethostname()
+    if args.concurrency <= 1:
+        run_worker(f'{hostname}:{os.getpid()}', args.db, encoder_processes)
+        return
+
+    processes = [
+        multiprocessing.Process(target=run_worker, args=(f'{hostname}:{i}', args.db, encoder_processes))
+        for i in range(args.concurrency)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+import threading
+import time
+from collections import deque
+import oqs
+
+
+class KEMKeypairPool():
+    '''
+    Bounded pool of pre-generated KEM key pairs.
+
+    A background thread tops the pool back up to the high watermark whenever it drops below the low
+    watermark, so handing out a key pair is a dequeue. liboqs is called through ctypes, which releases
+    the GIL, so key generation does not hold up the event loop. If the pool is empty (or was never
+    started) a key pair is generated inline and counted as a fallback.
+    '''
+
+    def __init__(self, algorithm: str, low_watermark: int = 8, high_watermark: int = 32):
+        if low_watermark < 0 or high_watermark < 1 or low_watermark > high_watermark:
+            raise ValueError('Pool watermarks must satisfy 0 <= low_watermark <= high_watermark and high_watermark >= 1')
+        self.algorithm = algorithm
+        self.low_watermark = low_watermark
+        self.high_watermark = high_watermark
+        self._pool = deque()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+        self.generated = 0
+        self.served_from_pool = 0
+        self.fallbacks = 0
+        self._generation_seconds = 0.0
+
+    def _generate(self) -> tuple:
+        kem = oqs.KeyEncapsulation(self.algorithm)
+        public_key = kem.generate_keypair()
+        return kem, public_key
+
+    def start(self) -> None:
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._stopped = False
+            self._thread = threading.Thread(target=self._refill_loop, name='kem-pool-refill', daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        with self._condition:
+            thread = self._thread
+            self._stopped = True
+            self._thread = None
+            self._condition.notify_all()
+        if thread is not None:
+            thread.join()
+
+        with self._condition:
+            while self._pool:
+                kem, _ = self._pool.popleft()
+                kem.free()
+
+    def acquire(self) -> tuple:
+        '''
+        Returns a (KeyEncapsulation, public_key) pair. The caller owns the KEM object and must free() it.
+        '''
+
+        with self._condition:
+            item = self._pool.popleft() if self._pool else None
+            if item is not None:
+                self.served_from_pool += 1
+            else:
+                self.fallbacks += 1
+            if len(self._pool) < self.low_watermark:
+                self._condition.notify()
+
+        if item is None:
+            item = self._generate()
+        return item
+
+    def _refill_loop(self) -> None:
+        while True:
+            with self._condition:
+                while not self._stopped and len(self._pool) >= self.low_watermark:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+
+            # Fill up to the high watermark without holding the lock while liboqs runs
+            while True:
+                with self._condition:
+                    if self._stopped or len(self._pool) >= self.high_watermark:
+                        break
+                start = time.perf_counter()
+                item = self._generate()
+                elapsed = time.perf_counter() - start
+                with self._condition:
+                    if self._stopped:
+                        item[0].free()
+                        return
+                    self._pool.append(item)
+                    self.generated += 1
+                    self._generation_seconds += elapsed
+
+    def stats(self) -> dict:
+        with self._condition:
+            refill_rate = self.generated / self._generation_seconds if self._generation_seconds else 0.0
+            return {
+                'depth': len(self._pool),
+                'low_watermark': self.low_watermark,
+                'high_watermark': self.high_watermark,
+                'generated': self.generated,
+                'served_from_pool': self.served_from_pool,
+                'fallbacks': self.fallbacks,
+                'refill_rate_per_sec': round(refill_rate, 2),
+                'running': self._thread is not None
+            }
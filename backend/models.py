@@ -0,0 +1,60 @@
+import json
+import os
+from copy import deepcopy
+from typing import Any, Optional
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
+from sqlalchemy.ext.mutable import MutableDict
+from sqlalchemy.types import JSON
+
+json_path = os.path.join(os.path.dirname(__file__), 'json_example.json')
+with open(json_path, 'r') as f:
+    DEFAULT_PREFS = json.load(f)
+
+# Face registration job states
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+
+class Base(DeclarativeBase):
+    pass
+
+
+class Device(Base):
+    __tablename__ = 'devices'
+
+    mac_address: Mapped[str] = mapped_column(primary_key=True)
+    username: Mapped[str]
+    password: Mapped[str]
+    nonce: Mapped[str]
+    secret: Mapped[str] # Shared secret used in TOTP, maybe encrypt?
+    totp_timestamp: Mapped[int]
+    preferences: Mapped[MutableDict[str, Any]] = mapped_column(
+        MutableDict.as_mutable(JSON),
+        default=lambda: deepcopy(DEFAULT_PREFS),
+        nullable=False
+    )
+
+
+class FaceRegistrationJob(Base):
+    '''
+    An uploaded registration video waiting for (or being processed by) face_worker.py.
+    '''
+
+    __tablename__ = 'face_registration_jobs'
+
+    id: Mapped[str] = mapped_column(primary_key=True)
+    username: Mapped[str]
+    video_path: Mapped[str]
+    replace: Mapped[bool] = mapped_column(default=False) # replace the user's encodings instead of adding to them
+    # Client retries of the same upload are answered with this job instead of being processed again
+    idempotency_key: Mapped[Optional[str]] = mapped_column(index=True)
+    content_hash: Mapped[Optional[str]] # sha256 of the uploaded video
+    status: Mapped[str] = mapped_column(default=JOB_QUEUED, index=True)
+    attempts: Mapped[int] = mapped_column(default=0)
+    worker: Mapped[Optional[str]]
+    encodings: Mapped[Optional[int]] # number of encodings extracted, once done
+    error: Mapped[Optional[str]]
+    queued_at: Mapped[float]
+    changed_at: Mapped[float] # last status change (not updated_at, which advanced_alchemy overwrites with a datetime)
@@ -0,0 +1,183 @@
+'''
+Rebuilds the encodings store from stored registration videos or frames, e.g. after changing the detection
+settings or the encodings format:
+
+    python reenroll.py registrations/ --processes 8 [--scale 0.5] [--budget 10] [--max-templates 5]
+
+The input directory has one subdirectory per user, named after the username, holding videos (sampled like
+a registration) and/or images. Users are encoded in parallel, one per process. Each finished user is
+checkpointed in --checkpoint, so running the same command again after an interruption (or after some users
+failed) only encodes the users still missing. Once every user is done, the whole store is replaced in one
+atomic index swap. Users that are in the store but not in the input directory are dropped.
+'''
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from encodings_store import EncodingsStore, ENCODINGS_DIR, ENCODING_DIM
+from face_encoder import load_models
+from face_templates import compact_templates
+from face_worker import FACE_TRACKING, FACE_DETECT_SCALE, FACE_ENCODING_BUDGET, FACE_TEMPLATES_MAX, FACE_TEMPLATES_DEDUPE_DISTANCE
+from train_model import encode_faces
+from video_encoding import iter_frames
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+SETTINGS_FILE = 'settings.json'
+
+
+def find_users(directory: str) -> dict[str, list[str]]:
+    '''
+    Returns the files of every user subdirectory, by username.
+    '''
+
+    users = {}
+    for username in sorted(os.listdir(directory)):
+        user_dir = os.path.join(directory, username)
+        if username.startswith('.') or not os.path.isdir(user_dir):
+            continue
+        users[username] = [os.path.join(user_dir, name) for name in sorted(os.listdir(user_dir)) if not name.startswith('.')]
+    return users
+
+
+def iter_user_frames(paths: list[str]):
+    for path in paths:
+        if path.lower().endswith(IMAGE_EXTENSIONS):
+            yield path # read by the encoder
+            continue
+        try:
+            yield from iter_frames(path)
+        except Exception as e:
+            print(f"[WARNING] skipping {path}: {getattr(e, 'detail', None) or e}")
+
+
+def encode_user(paths: list[str], settings: dict) -> np.ndarray:
+    '''
+    Returns the (N, 128) encodings for one user's files, with the given detection and templates settings.
+    '''
+
+    encodings = encode_faces(iter_user_frames(paths), None, settings['track'], settings['scale'], settings['budget'])
+    matrix = np.asarray(encodings, dtype=np.float64).reshape(-1, ENCODING_DIM)
+    if settings['max_templates']:
+        matrix = compact_templates(matrix, settings['max_templates'], settings['dedupe_distance'])
+    return matrix
+
+
+def _open_checkpoint(checkpoint_dir: str, settings: dict) -> None:
+    settings_path = os.path.join(checkpoint_dir, SETTINGS_FILE)
+    if os.path.exists(settings_path):
+        with open(settings_path) as f:
+            if json.load(f) == settings:
+                return
+        print(f"[WARNING] '{checkpoint_dir}' was made with other settings, starting over")
+        shutil.rmtree(checkpoint_dir)
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    with open(settings_path, 'w') as f:
+        json.dump(settings, f)
+
+
+def _checkpoint_path(checkpoint_dir: str, username: str) -> str:
+    return os.path.join(checkpoint_dir, f'{username}.npy')
+
+
+def _save_checkpoint(checkpoint_dir: str, username: str, matrix: np.ndarray) -> None:
+    path = _checkpoint_path(checkpoint_dir, username)
+    with open(f'{path}.tmp', 'wb') as f:
+        np.save(f, matrix)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(f'{path}.tmp', path)
+
+
+def reenroll(input_dir: str, store: EncodingsStore, checkpoint_dir: str, settings: dict, processes: int = None) -> dict:
+    '''
+    Encodes every user in input_dir that isn't checkpointed yet, then rewrites the store with all of them.
+    Returns the new index, or None if some users failed (they are retried on the next run).
+    '''
+
+    users = find_users(input_dir)
+    _open_checkpoint(checkpoint_dir, settings)
+    pending = {username: paths for username, paths in users.items() if not os.path.exists(_checkpoint_path(checkpoint_dir, username))}
+    print(f"[INFO] {len(users) - len(pending)} of {len(users)} users already checkpointed")
+
+    failed = []
+
+    def finished(username: str, matrix: np.ndarray) -> None:
+        _save_checkpoint(checkpoint_dir, username, matrix)
+        done = len(users) - len(pending) + 1
+        pending.pop(username)
+        print(f"[INFO] {username}: {len(matrix)} encodings ({done}/{len(users)})")
+
+    if processes is not None and processes <= 1:
+        for username, paths in list(pending.items()):
+            try:
+                finished(username, encode_user(paths, settings))
+            except Exception:
+                logging.exception(f"Re-enrolling {username} failed")
+                failed.append(username)
+    else:
+        # spawn rather than fork, like FaceEncoderPool: dlib isn't fork-safe
+        with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=load_models) as executor:
+            futures = {executor.submit(encode_user, paths, settings): username for username, paths in pending.items()}
+            for future in as_completed(futures):
+                username = futures[future]
+                try:
+                    finished(username, future.result())
+                except Exception:
+                    logging.exception(f"Re-enrolling {username} failed")
+                    failed.append(username)
+
+    if failed:
+        print(f"[ERROR] {len(failed)} users failed ({', '.join(sorted(failed))}), run again to retry them")
+        return None
+
+    names, rows = [], []
+    for username in users:
+        matrix = np.load(_checkpoint_path(checkpoint_dir, username))
+        if not len(matrix):
+            print(f"[WARNING] no face found for {username}")
+        names.extend([username] * len(matrix))
+        rows.append(matrix)
+    dropped = set(store.load()[1]) - set(users)
+    if dropped:
+        print(f"[WARNING] dropping {len(dropped)} users that have no files in '{input_dir}'")
+    index = store.rewrite(names, np.concatenate(rows) if rows else np.empty((0, store.dim)))
+    shutil.rmtree(checkpoint_dir)
+    print(f"[INFO] Re-enrollment complete. {len(names)} encodings of {len(users)} users written to '{store.directory}'")
+    return index
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Rebuild the encodings store from stored registration videos or frames.')
+    parser.add_argument('input', help='directory with one subdirectory of videos and/or images per user')
+    parser.add_argument('--store', default=ENCODINGS_DIR, help='encodings store directory to rebuild')
+    parser.add_argument('--checkpoint', help='directory for per-user progress (default: <store>.reenroll)')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help='users encoded in parallel')
+    parser.add_argument('--scale', type=float, default=FACE_DETECT_SCALE, help='face detection scale')
+    parser.add_argument('--no-tracking', action='store_true', help='detect faces in the whole of every frame')
+    parser.add_argument('--budget', type=int, default=FACE_ENCODING_BUDGET, help='distinct encodings per user (0 for every frame)')
+    parser.add_argument('--max-templates', type=int, default=FACE_TEMPLATES_MAX, help='rows kept per user (0 keeps every encoding)')
+    parser.add_argument('--dedupe-distance', type=float, default=FACE_TEMPLATES_DEDUPE_DISTANCE)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    settings = {
+        'track': FACE_TRACKING and not args.no_tracking,
+        'scale': args.scale,
+        'budget': args.budget,
+        'max_templates': args.max_templates,
+        'dedupe_distance': args.dedupe_distance
+    }
+    store = EncodingsStore(args.store)
+    index = reenroll(args.input, store, args.checkpoint or f'{args.store.rstrip(os.sep)}.reenroll', settings, args.processes)
+    if index is None:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,447 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+
+class SessionStore():
+    '''
+    Interface for the per-client session state kept by EncryptionHelper (pending KEM sessions and
+    established shared secrets). Supports the small dict-like surface the helper and tests rely on.
+    '''
+
+    def get(self, key: str, default: Any = None) -> Any:
+        raise NotImplementedError
+
+    def set(self, key: str, value: Any) -> None:
+        raise NotImplementedError
+
+    def pop(self, key: str, default: Any = None) -> Any:
+        raise NotImplementedError
+
+    def sweep(self) -> int:
+        '''
+        Removes expired entries and returns how many were removed.
+        '''
+        return 0
+
+    def invalidate(self, key: str) -> None:
+        '''
+        Drops any locally cached copy of the entry. Only meaningful for cached stores.
+        '''
+        pass
+
+    def stats(self) -> dict:
+        return {}
+
+    def start(self) -> None:
+        pass
+
+    def stop(self) -> None:
+        pass
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    def __getitem__(self, key: str) -> Any:
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        self.set(key, value)
+
+    def __delitem__(self, key: str) -> None:
+        if self.pop(key) is None:
+            raise KeyError(key)
+
+
+class MemorySessionStore(SessionStore):
+    '''
+    In-process store with an idle TTL (refreshed on every read), LRU eviction once max_entries is
+    reached, and an optional background sweeper thread. on_evict is called with (key, value) whenever the
+    store drops an entry on its own (expiry, capacity, or being overwritten) so native resources such
+    as KEM handles can be freed; values handed back by pop() belong to the caller.
+    '''
+
+    def __init__(self, ttl: Optional[float] = None, max_entries: Optional[int] = None,
+                 on_evict: Optional[Callable[[str, Any], None]] = None, sweep_interval: float = 30.0):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.on_evict = on_evict
+        self.sweep_interval = sweep_interval
+        self._entries = OrderedDict() # key -> (value, expires_at)
+        self._lock = threading.Lock()
+        self._sweeper = None
+        self._stop_event = threading.Event()
+
+        self.expired = 0
+        self.evicted = 0
+
+    def _expiry(self) -> Optional[float]:
+        return time.monotonic() + self.ttl if self.ttl is not None else None
+
+    def _evict(self, dropped: list) -> None:
+        if self.on_evict is None:
+            return
+        for key, value in dropped:
+            self.on_evict(key, value)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        dropped = []
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._entries[key]
+                self.expired += 1
+                dropped.append((key, value))
+                value = default
+            else:
+                self._entries[key] = (value, self._expiry())
+                self._entries.move_to_end(key)
+        self._evict(dropped)
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        dropped = []
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None and previous[0] is not value:
+                dropped.append((key, previous[0]))
+            self._entries[key] = (value, self._expiry())
+            if self.max_entries is not None:
+                while len(self._entries) > self.max_entries:
+                    oldest_key, (oldest_value, _) = self._entries.popitem(last=False)
+                    dropped.append((oldest_key, oldest_value))
+                    self.evicted += 1
+        self._evict(dropped)
+
+    def pop(self, key: str, default: Any = None) -> Any:
+        dropped = []
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                self.expired += 1
+                dropped.append((key, value))
+                value = default
+        self._evict(dropped)
+        return value
+
+    def sweep(self) -> int:
+        now = time.monotonic()
+        dropped = []
+        with self._lock:
+            for key, (value, expires_at) in list(self._entries.items()):
+                if expires_at is not None and expires_at <= now:
+                    del self._entries[key]
+                    dropped.append((key, value))
+            self.expired += len(dropped)
+        self._evict(dropped)
+        return len(dropped)
+
+    def _sweep_loop(self) -> None:
+        while not self._stop_event.wait(self.sweep_interval):
+            self.sweep()
+
+    def start(self) -> None:
+        if self.ttl is None or self._sweeper is not None:
+            return
+        self._stop_event.clear()
+        self._sweeper = threading.Thread(target=self._sweep_loop, name='session-sweeper', daemon=True)
+        self._sweeper.start()
+
+    def stop(self) -> None:
+        if self._sweeper is None:
+            return
+        self._stop_event.set()
+        self._sweeper.join()
+        self._sweeper = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'live': len(self._entries),
+                'expired': self.expired,
+                'evicted': self.evicted,
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl
+            }
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+
+def _wrap(wrap_key: bytes, name: str, value: bytes) -> bytes:
+    # The name is bound as associated data so a wrapped value cannot be replayed under another client_id or namespace
+    nonce = os.urandom(12)
+    return nonce + AESGCM(wrap_key).encrypt(nonce, value, name.encode())
+
+
+def _unwrap(wrap_key: bytes, name: str, blob: bytes) -> bytes:
+    return AESGCM(wrap_key).decrypt(blob[:12], blob[12:], name.encode())
+
+
+class SQLiteSessionStore(SessionStore):
+    '''
+    Session store shared by every worker process on a host, backed by a SQLite database in WAL mode.
+    Values must be bytes; they are stored wrapped (AES-GCM) under wrap_key. Expiry uses wall-clock time
+    so that all processes agree on it, and the TTL is refreshed on every read.
+    '''
+
+    def __init__(self, path: str, wrap_key: bytes, namespace: str, ttl: Optional[float] = None,
+                 max_entries: Optional[int] = None, sweep_interval: float = 30.0):
+        self.path = path
+        self.wrap_key = wrap_key
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.sweep_interval = sweep_interval
+        self._local = threading.local()
+        self._sweeper = None
+        self._stop_event = threading.Event()
+
+        self.expired = 0
+        self.evicted = 0
+
+        with self._connection() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS sessions ('
+                'namespace TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, expires_at REAL, '
+                'PRIMARY KEY (namespace, key))'
+            )
+            connection.execute('CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions (namespace, expires_at)')
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def _expiry(self) -> Optional[float]:
+        return time.time() + self.ttl if self.ttl is not None else None
+
+    def get(self, key: str, default: Any = None) -> Any:
+        connection = self._connection()
+        row = connection.execute(
+            'SELECT value, expires_at FROM sessions WHERE namespace = ? AND key = ?', (self.namespace, key)
+        ).fetchone()
+        if row is None:
+            return default
+        blob, expires_at = row
+        if expires_at is not None and expires_at <= time.time():
+            return default
+        if self.ttl is not None:
+            connection.execute(
+                'UPDATE sessions SET expires_at = ? WHERE namespace = ? AND key = ?', (self._expiry(), self.namespace, key)
+            )
+        return _unwrap(self.wrap_key, f'{self.namespace}:{key}', blob)
+
+    def set(self, key: str, value: bytes) -> None:
+        self._connection().execute(
+            'INSERT OR REPLACE INTO sessions (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)',
+            (self.namespace, key, _wrap(self.wrap_key, f'{self.namespace}:{key}', value), self._expiry())
+        )
+
+    def pop(self, key: str, default: Any = None) -> Any:
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute(
+                'SELECT value, expires_at FROM sessions WHERE namespace = ? AND key = ?', (self.namespace, key)
+            ).fetchone()
+            connection.execute('DELETE FROM sessions WHERE namespace = ? AND key = ?', (self.namespace, key))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            return default
+        return _unwrap(self.wrap_key, f'{self.namespace}:{key}', row[0])
+
+    def sweep(self) -> int:
+        connection = self._connection()
+        removed = connection.execute(
+            'DELETE FROM sessions WHERE namespace = ? AND expires_at <= ?', (self.namespace, time.time())
+        ).rowcount
+        self.expired += removed
+        if self.max_entries is not None:
+            # Entries closest to expiry are the least recently used ones
+            evicted = connection.execute(
+                'DELETE FROM sessions WHERE namespace = ? AND key IN ('
+                'SELECT key FROM sessions WHERE namespace = ? ORDER BY expires_at DESC LIMIT -1 OFFSET ?)',
+                (self.namespace, self.namespace, self.max_entries)
+            ).rowcount
+            self.evicted += evicted
+        return removed
+
+    def _sweep_loop(self) -> None:
+        while not self._stop_event.wait(self.sweep_interval):
+            self.sweep()
+
+    def start(self) -> None:
+        if self._sweeper is not None:
+            return
+        self._stop_event.clear()
+        self._sweeper = threading.Thread(target=self._sweep_loop, name='session-sweeper', daemon=True)
+        self._sweeper.start()
+
+    def stop(self) -> None:
+        if self._sweeper is None:
+            return
+        self._stop_event.set()
+        self._sweeper.join()
+        self._sweeper = None
+
+    def stats(self) -> dict:
+        return {
+            'backend': 'sqlite',
+            'live': len(self),
+            'expired': self.expired,
+            'evicted': self.evicted,
+            'max_entries': self.max_entries,
+            'ttl_seconds': self.ttl
+        }
+
+    def __len__(self) -> int:
+        return self._connection().execute(
+            'SELECT COUNT(*) FROM sessions WHERE namespace = ? AND (expires_at IS NULL OR expires_at > ?)',
+            (self.namespace, time.time())
+        ).fetchone()[0]
+
+
+class RedisSessionStore(SessionStore):
+    '''
+    Session store shared across hosts through any server speaking the Redis protocol. client must
+    provide the redis-py methods used here (set, getex, getdel, scan_iter); values are wrapped under
+    wrap_key before they leave the process and expiry is delegated to the server.
+    '''
+
+    def __init__(self, client: Any, wrap_key: bytes, namespace: str, ttl: Optional[float] = None):
+        self.client = client
+        self.wrap_key = wrap_key
+        self.namespace = namespace
+        self.ttl = ttl
+
+    @classmethod
+    def from_url(cls, url: str, wrap_key: bytes, namespace: str, ttl: Optional[float] = None) -> 'RedisSessionStore':
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('The redis package is required for SESSION_STORE=redis')
+        return cls(redis.Redis.from_url(url), wrap_key, namespace, ttl)
+
+    def _name(self, key: str) -> str:
+        return f'{self.namespace}:{key}'
+
+    def _ex(self) -> Optional[int]:
+        return max(1, int(self.ttl)) if self.ttl is not None else None
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if self.ttl is not None:
+            blob = self.client.getex(self._name(key), ex=self._ex())
+        else:
+            blob = self.client.getex(self._name(key))
+        return _unwrap(self.wrap_key, self._name(key), blob) if blob is not None else default
+
+    def set(self, key: str, value: bytes) -> None:
+        self.client.set(self._name(key), _wrap(self.wrap_key, self._name(key), value), ex=self._ex())
+
+    def pop(self, key: str, default: Any = None) -> Any:
+        blob = self.client.getdel(self._name(key))
+        return _unwrap(self.wrap_key, self._name(key), blob) if blob is not None else default
+
+    def stats(self) -> dict:
+        return {'backend': 'redis', 'live': len(self), 'ttl_seconds': self.ttl}
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self.client.scan_iter(match=f'{self.namespace}:*'))
+
+
+class CachedSessionStore(SessionStore):
+    '''
+    Per-worker read-through cache in front of a shared store. Cached entries live for cache_ttl seconds,
+    which bounds how long a worker can keep using a secret that was replaced by a handshake on another
+    worker; invalidate() drops an entry early, e.g. after a decryption failure.
+    '''
+
+    def __init__(self, backend: SessionStore, cache_ttl: float = 2.0, max_entries: Optional[int] = None):
+        self.backend = backend
+        self.cache = MemorySessionStore(ttl=cache_ttl, max_entries=max_entries)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str, default: Any = None) -> Any:
+        value = self.cache.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = self.backend.get(key)
+        if value is None:
+            return default
+        self.cache.set(key, value)
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        self.backend.set(key, value)
+        self.cache.set(key, value)
+
+    def pop(self, key: str, default: Any = None) -> Any:
+        self.cache.pop(key)
+        return self.backend.pop(key, default)
+
+    def invalidate(self, key: str) -> None:
+        self.cache.pop(key)
+
+    def sweep(self) -> int:
+        self.cache.sweep()
+        return self.backend.sweep()
+
+    def start(self) -> None:
+        self.cache.start()
+        self.backend.start()
+
+    def stop(self) -> None:
+        self.cache.stop()
+        self.backend.stop()
+
+    def stats(self) -> dict:
+        return self.backend.stats() | {'cache_hits': self.hits, 'cache_misses': self.misses, 'cached': len(self.cache)}
+
+    def __len__(self) -> int:
+        return len(self.backend)
+
+
+def build_session_store(backend: str, namespace: str, ttl: Optional[float], max_entries: Optional[int],
+                        wrap_key: bytes, url: Optional[str] = None, cache_ttl: Optional[float] = 2.0) -> SessionStore:
+    '''
+    Returns a shared session store for SESSION_STORE=sqlite or SESSION_STORE=redis, fronted by a per-worker
+    cache unless cache_ttl is None.
+    '''
+
+    if backend == 'sqlite':
+        shared = SQLiteSessionStore(url or 'sessions.sqlite', wrap_key, namespace, ttl, max_entries)
+    elif backend == 'redis':
+        shared = RedisSessionStore.from_url(url or 'redis://localhost:6379/0', wrap_key, namespace, ttl)
+    else:
+        raise ValueError(f'Unknown session store backend: {backend}')
+    if cache_ttl is None:
+        return shared
+    return CachedSessionStore(shared, cache_ttl=cache_ttl, max_entries=max_entries)
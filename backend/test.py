@@ -7,6 +7,37 @@ import pytest_asyncio
 import os
 import oqs
 import base64
+import asyncio
+import multiprocessing
+import shutil
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+from litestar.exceptions import HTTPException
+from sqlalchemy.orm import Session
+import app as server
+import encodings_cache as cache_module
+import face_encoder
+import face_templates
+import face_worker
+import reenroll
+from ann_index import IVFIndex
+from encodings_cache import EncodingsCache
+from encodings_codec import encode_matrix, decode_matrix
+from encodings_store import EncodingsStore, MAX_SEGMENTS
+from encryption_helper import BINARY_MEDIA_TYPE
+from executors import BoundedExecutor
+from face_encoder import EncodingBudget, FaceEncoderPool, rank_frames
+from face_matching import FaceMatcher
+from models import FaceRegistrationJob, JOB_FAILED, JOB_QUEUED, JOB_RUNNING
+from face_templates import compact_store, compact_templates
+from face_worker import create_db_engine, claim_job, finish_job, requeue_stale_jobs
+from session_store import MemorySessionStore, SQLiteSessionStore, RedisSessionStore, CachedSessionStore
+from train_model import train_model
+from video_encoding import sample_indices, sample_frames, iter_frames
 
 
 TEST_DB_FILENAME = 'test_db.sqlite'
@@ -30,6 +61,52 @@ async def test_client() -> AsyncIterator[AsyncTestClient[Litestar]]:
     # Delete test database after each test
     os.remove(TEST_DB_FILENAME)
 
+@pytest.fixture
+def isolated_storage(monkeypatch, tmp_path) -> EncodingsStore:
+    '''
+    Points the app at its own encodings store (migrated from encodings.pickle) and videos directory under
+    tmp_path, so tests never change the real ones.
+    '''
+
+    store = EncodingsStore(str(tmp_path / 'encodings'), legacy_pickle='encodings.pickle')
+    monkeypatch.setattr(server, 'encodings_store', store)
+    monkeypatch.setattr(server, 'encodings_cache', EncodingsCache(store))
+    monkeypatch.setattr(server, 'VIDEOS_DIR', str(tmp_path / 'videos'))
+    return store
+
+class FakeFaceRecognition():
+    '''
+    Stands in for face_recognition: the face is the bounding box of the pixels with some red, and its
+    encoding is the box followed by the red value (0-1) at the box's top left corner.
+    '''
+
+    def face_locations(self, rgb, model='hog'):
+        ys, xs = np.nonzero(rgb[:, :, 0])
+        if len(ys) == 0:
+            return []
+        return [(int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1, int(xs.min()))]
+
+    def face_encodings(self, rgb, boxes):
+        return [np.concatenate([box, np.full(124, rgb[box[0], box[3], 0] / 255)]) for box in boxes]
+
+@pytest.fixture
+def fake_face_recognition(monkeypatch) -> FakeFaceRecognition:
+    fake = FakeFaceRecognition()
+    monkeypatch.setattr(face_encoder, 'face_recognition', fake)
+    return fake
+
+async def registered_device(client: AsyncTestClient, mac_address: str, username: str) -> str:
+    '''
+    Registers a device for username through /batch and returns its MAC address.
+    '''
+
+    device = {'mac_address': mac_address, 'username': username, 'password': 'password', 'secret': 'secret', 'timestamp': 0}
+    data = {'operations': [{'op': 'register', 'args': device}]}
+    encrypted_data = {'client_id': TEST_CLIENT_ID_1} | encryption_helper.encrypt_msg(data, TEST_CLIENT_ID_1)
+    response = await client.post('/batch', json=encrypted_data)
+    assert response.status_code == 201
+    return mac_address
+
 @pytest.mark.asyncio
 async def test_home(test_client: AsyncTestClient[Litestar]) -> None:
     response = await test_client.get('/')
@@ -225,5 +302,659 @@ async def test_kem_initiate_and_complete(test_client: AsyncTestClient) -> None:
     assert shared_secret == encryption_helper.shared_secrets.get(TEST_CLIENT_ID_1)
 
 @pytest.mark.asyncio
-async def test_register_face(test_client: AsyncTestClient) -> None:
-    pass
+async def test_register_face(test_client: AsyncTestClient, isolated_storage: EncodingsStore) -> None:
+    mac_address = await registered_device(test_client, 'aa:bb:cc:dd:ee:03', 'face_user')
+
+    response = await test_client.post('/register/face', data={'mac_address': mac_address}, files={'video': ('video.webm', b'webm', 'video/webm')})
+    assert response.status_code == 202
+    job_id = response.json()['job_id']
+    response = await test_client.get(f'/register/face/{job_id}')
+    assert response.json()['status'] == 'queued'
+
+    with Session(create_db_engine('db.sqlite'), expire_on_commit=False) as session:
+        job = claim_job(session, 'test')
+        assert job.id == job_id and job.username == 'face_user' and job.attempts == 1
+        assert open(job.video_path, 'rb').read() == b'webm'
+        assert claim_job(session, 'test') is None
+        response = await test_client.get(f'/register/face/{job_id}')
+        assert response.json()['status'] == 'running'
+        finish_job(session, job, encodings=3)
+        assert not os.path.exists(job.video_path)
+
+    response = await test_client.get(f'/register/face/{job_id}')
+    assert response.json() | {'job_id': job_id} == {'job_id': job_id, 'status': 'done', 'attempts': 1, 'encodings': 3, 'error': None}
+
+    response = await test_client.post('/register/face', data={'mac_address': '00:00:00:00:00:00'}, files={'video': ('video.webm', b'webm', 'video/webm')})
+    assert response.status_code == 404
+    response = await test_client.get('/register/face/unknown')
+    assert response.status_code == 404
+
+def test_requeue_stale_jobs(tmp_path) -> None:
+    with Session(create_db_engine(str(tmp_path / 'jobs.sqlite')), expire_on_commit=False) as session:
+        for job_id, attempts in [('retried', 1), ('exhausted', face_worker.JOB_MAX_ATTEMPTS)]:
+            os.makedirs(tmp_path / job_id)
+            session.add(FaceRegistrationJob(id=job_id, username='user', video_path=str(tmp_path / job_id / 'video.webm'),
+                                            status=JOB_RUNNING, attempts=attempts, queued_at=0, changed_at=0))
+        session.commit()
+
+        assert requeue_stale_jobs(session, stale_seconds=60) == 1
+        assert session.get(FaceRegistrationJob, 'retried').status == JOB_QUEUED
+        assert session.get(FaceRegistrationJob, 'exhausted').status == JOB_FAILED
+        # The failed job's video is removed like any finished job's, the requeued one is kept for the retry
+        assert os.path.exists(tmp_path / 'retried') and not os.path.exists(tmp_path / 'exhausted')
+
+@pytest.mark.asyncio
+async def test_kem_pool_stats(test_client: AsyncTestClient) -> None:
+    stats_before = encryption_helper.keypair_pool.stats()
+
+    data = {'client_id': TEST_CLIENT_ID_2}
+    response = await test_client.post('/kem/initiate', json=data)
+    assert response.json().get('public_key_b64')
+
+    response = await test_client.get('/stats')
+    stats = response.json()['kem_pool']
+    assert stats['running']
+    assert stats['served_from_pool'] + stats['fallbacks'] == stats_before['served_from_pool'] + stats_before['fallbacks'] + 1
+    assert stats['depth'] <= stats['high_watermark']
+
+def test_session_store_expiry_and_eviction() -> None:
+    evicted = []
+    store = MemorySessionStore(ttl=60, max_entries=2, on_evict=lambda key, value: evicted.append(key))
+    store['a'] = 1
+    store['b'] = 2
+    assert store.get('a') == 1 # 'a' is now the most recently used entry
+    store['c'] = 3
+    assert evicted == ['b']
+    assert store.get('b') is None
+    assert len(store) == 2
+
+    store.ttl = 0
+    store['d'] = 4
+    assert store.sweep() >= 1
+    assert 'd' in evicted
+    stats = store.stats()
+    assert stats['evicted'] == 2
+    assert stats['live'] == len(store)
+
+class FakeRedis():
+    '''
+    Local stand-in for a Redis server, implementing only the commands RedisSessionStore uses.
+    '''
+
+    def __init__(self):
+        self.data = {}
+
+    def set(self, name, value, ex=None):
+        self.data[name] = value
+
+    def getex(self, name, ex=None):
+        return self.data.get(name)
+
+    def getdel(self, name):
+        return self.data.pop(name, None)
+
+    def scan_iter(self, match='*'):
+        return [name for name in self.data if name.startswith(match.rstrip('*'))]
+
+def test_shared_session_store_requires_aes_key() -> None:
+    # An empty AES_KEY also keeps .env from supplying one
+    env = os.environ | {'SESSION_STORE': 'sqlite', 'AES_KEY': ''}
+    result = subprocess.run([sys.executable, '-c', 'import app'], env=env, capture_output=True, text=True)
+    assert result.returncode != 0 and 'AES_KEY must be set' in result.stderr
+
+def test_shared_session_stores(tmp_path) -> None:
+    wrap_key = os.urandom(32)
+    db_path = str(tmp_path / 'sessions.sqlite')
+    # Two stores on the same database stand in for two worker processes
+    worker_1 = CachedSessionStore(SQLiteSessionStore(db_path, wrap_key, 'secret', ttl=60))
+    worker_2 = CachedSessionStore(SQLiteSessionStore(db_path, wrap_key, 'secret', ttl=60))
+    worker_1[TEST_CLIENT_ID_1] = TEST_SHARED_SECRET_1
+    assert worker_2.get(TEST_CLIENT_ID_1) == TEST_SHARED_SECRET_1
+    assert worker_2.pop(TEST_CLIENT_ID_1) == TEST_SHARED_SECRET_1
+    worker_1.invalidate(TEST_CLIENT_ID_1)
+    assert worker_1.get(TEST_CLIENT_ID_1) is None
+
+    client = FakeRedis()
+    store = RedisSessionStore(client, wrap_key, 'secret', ttl=60)
+    store[TEST_CLIENT_ID_2] = TEST_SHARED_SECRET_2
+    assert TEST_SHARED_SECRET_2 not in client.data.values() # stored wrapped under the key
+    assert store.get(TEST_CLIENT_ID_2) == TEST_SHARED_SECRET_2
+    assert len(store) == 1
+
+def test_cipher_cache() -> None:
+    client_id = 'cipher-cache-test'
+    encryption_helper.shared_secrets[client_id] = TEST_SHARED_SECRET_1
+    cipher = encryption_helper.get_cipher(client_id)
+    encrypted_data = encryption_helper.encrypt_msg({'a': 1}, client_id)
+    assert encryption_helper.get_cipher(client_id) is cipher
+    assert encryption_helper.decrypt_msg(EncryptedMessageRequest(client_id=client_id, **encrypted_data)) == {'a': 1}
+
+    # A new shared secret must not reuse the old cipher
+    encryption_helper.shared_secrets[client_id] = TEST_SHARED_SECRET_2
+    assert encryption_helper.get_cipher(client_id) is not cipher
+    encryption_helper.shared_secrets.pop(client_id)
+
+@pytest.mark.asyncio
+async def test_binary_envelope(test_client: AsyncTestClient) -> None:
+    mac_address = 'aa:bb:cc:dd:ee:01'
+    data = {
+        'mac_address': mac_address,
+        'username': 'binary_user',
+        'password': 'password',
+        'secret': 'secret',
+        'timestamp': 0
+    }
+    body = encryption_helper.encrypt_envelope(data, TEST_CLIENT_ID_1)
+    response = await test_client.post('/register', content=body, headers={'Content-Type': BINARY_MEDIA_TYPE})
+    assert response.status_code == 201
+    assert response.headers['content-type'].startswith(BINARY_MEDIA_TYPE)
+    client_id, response_data = encryption_helper.decrypt_envelope(response.content)
+    assert client_id == TEST_CLIENT_ID_1
+    assert response_data['status'] == 'success'
+
+    # Binary responses are negotiated through the Accept header on GET endpoints
+    response = await test_client.get(f'/devices/{mac_address}/username?client_id={TEST_CLIENT_ID_1}', headers={'Accept': BINARY_MEDIA_TYPE})
+    _, response_data = encryption_helper.decrypt_envelope(response.content)
+    assert response_data['username'] == 'binary_user'
+
+    response = await test_client.get(f'/devices/{mac_address}/username?client_id={TEST_CLIENT_ID_1}')
+    response_data = encryption_helper.decrypt_msg(EncryptedMessageRequest(**({'client_id': TEST_CLIENT_ID_1} | response.json())))
+    assert response_data['username'] == 'binary_user'
+
+@pytest.mark.asyncio
+async def test_batch(test_client: AsyncTestClient) -> None:
+    mac_address = 'aa:bb:cc:dd:ee:02'
+    device = {
+        'mac_address': mac_address,
+        'username': 'batch_user',
+        'password': 'password',
+        'secret': 'secret',
+        'timestamp': 0
+    }
+    data = {'operations': [
+        {'op': 'register', 'args': device},
+        {'op': 'register', 'args': device},
+        {'op': 'get_username', 'args': {'mac_address': mac_address}},
+        {'op': 'get_preferences', 'args': {'username': 'batch_user'}},
+        {'op': 'get_username', 'args': {'mac_address': '00:00:00:00:00:00'}},
+        {'op': 'unknown'}
+    ]}
+    encrypted_data = {'client_id': TEST_CLIENT_ID_1} | encryption_helper.encrypt_msg(data, TEST_CLIENT_ID_1)
+    response = await test_client.post('/batch', json=encrypted_data)
+    assert response.status_code == 201
+    results = encryption_helper.decrypt_msg(EncryptedMessageRequest(**({'client_id': TEST_CLIENT_ID_1} | response.json())))['results']
+    assert [result['status_code'] for result in results] == [200, 409, 200, 200, 404, 400]
+    assert results[2]['result']['username'] == 'batch_user'
+    assert results[3]['result']['preferences'] == DEFAULT_PREFS
+
+@pytest.mark.asyncio
+async def test_batch_rollback(test_client: AsyncTestClient) -> None:
+    # Operations run in savepoints of the request's transaction, so when it rolls back none of them is kept
+    mac_address = 'aa:bb:cc:dd:ee:06'
+    device = {'mac_address': mac_address, 'username': 'rollback_user', 'password': 'password', 'secret': 'secret', 'timestamp': 0}
+    session_maker = server.db_config.create_session_maker()
+    with pytest.raises(RuntimeError):
+        async with session_maker() as session, session.begin():
+            async with session.begin_nested():
+                await server.register_device_op(device, session)
+            with pytest.raises(HTTPException):
+                async with session.begin_nested():
+                    await server.register_device_op(device, session)
+            raise RuntimeError('later operation failed')
+
+    async with session_maker() as session:
+        assert await server.fetch_username(mac_address, session) is None
+
+@pytest.mark.asyncio
+async def test_get_encodings_cached(test_client: AsyncTestClient, isolated_storage: EncodingsStore) -> None:
+    encodings_cache = server.encodings_cache
+
+    response = await test_client.get(f'/encodings?client_id={TEST_CLIENT_ID_1}')
+    first = encryption_helper.decrypt_msg(EncryptedMessageRequest(**({'client_id': TEST_CLIENT_ID_1} | response.json())))
+    reloads = encodings_cache.stats()['reloads']
+
+    response = await test_client.get(f'/encodings?client_id={TEST_CLIENT_ID_1}')
+    second = encryption_helper.decrypt_msg(EncryptedMessageRequest(**({'client_id': TEST_CLIENT_ID_1} | response.json())))
+    assert second == first
+    assert encodings_cache.stats()['reloads'] == reloads
+
+    # A change to the store forces a reload
+    isolated_storage.append('reload_user', np.zeros((1, 128)))
+    response = await test_client.get(f'/encodings?client_id={TEST_CLIENT_ID_1}')
+    assert encodings_cache.stats()['reloads'] == reloads + 1
+
+def test_encodings_cache_serialization_does_not_block(monkeypatch, tmp_path) -> None:
+    store = EncodingsStore(str(tmp_path), legacy_pickle=None)
+    store.append('user', np.zeros((2, 128)))
+    cache = EncodingsCache(store)
+    version = cache.version()
+
+    started, release = threading.Event(), threading.Event()
+    encode_matrix = cache_module.encode_matrix
+    def slow_encode_matrix(*args):
+        started.set()
+        release.wait(5)
+        return encode_matrix(*args)
+    monkeypatch.setattr(cache_module, 'encode_matrix', slow_encode_matrix)
+
+    thread = threading.Thread(target=cache.serialized)
+    thread.start()
+    try:
+        assert started.wait(5)
+        # Neither waits for the serialization in progress
+        with ThreadPoolExecutor(1) as executor:
+            assert executor.submit(cache.version).result(timeout=1) == version
+            assert executor.submit(cache.stats).result(timeout=1)['rows'] == 2
+    finally:
+        release.set()
+        thread.join()
+
+def test_encodings_store(tmp_path) -> None:
+    # The legacy pickle is migrated on first use
+    store = EncodingsStore(str(tmp_path / 'encodings'), legacy_pickle='encodings.pickle')
+    matrix, names = store.load()
+    migrated = len(names)
+    assert migrated > 0
+    assert matrix.shape == (migrated, 128)
+
+    new_rows = np.random.default_rng(0).normal(size=(3, 128))
+    index = store.append('new_user', new_rows)
+    assert index['users'][-1] == ['new_user', migrated, 3]
+    matrix, names = store.load()
+    assert names[-3:] == ['new_user'] * 3
+    assert np.allclose(matrix[-3:], new_rows)
+
+    # The data file stays a valid .npy file, and holds the appended rows once compacted
+    store.compact()
+    assert store.index()['segments'] == []
+    assert np.load(str(tmp_path / 'encodings' / index['data_file'])).shape == (migrated + 3, 128)
+
+    store.rewrite(['new_user'] * 3, new_rows)
+    matrix, names = store.load()
+    assert names == ['new_user'] * 3
+    assert np.allclose(matrix, new_rows)
+
+@pytest.mark.asyncio
+async def test_get_encodings_delta(test_client: AsyncTestClient, isolated_storage: EncodingsStore) -> None:
+    response = await test_client.get(f'/encodings?client_id={TEST_CLIENT_ID_1}')
+    etag = response.headers['etag']
+    full = encryption_helper.decrypt_msg(EncryptedMessageRequest(**({'client_id': TEST_CLIENT_ID_1} | response.json())))
+    assert full['full']
+
+    # Nothing changed, so no encryption work is done: only the version check runs on the io pool
+    completed = server.io_executor.completed
+    response = await test_client.get(f'/encodings?client_id={TEST_CLIENT_ID_1}', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert server.io_executor.completed == completed + 1
+
+    isolated_storage.append('delta_user', np.zeros((2, 128)))
+    response = await test_client.get(f'/encodings?client_id={TEST_CLIENT_ID_1}&since={full["version"]}', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    delta = encryption_helper.decrypt_msg(EncryptedMessageRequest(**({'client_id': TEST_CLIENT_ID_1} | response.json())))
+    assert delta['version'] == full['version'] + 1
+    assert delta['removed'] == []
+    assert delta['added']['names'] == ['delta_user', 'delta_user']
+
+    # Versions older than the change log get a full resync
+    response = await test_client.get(f'/encodings?client_id={TEST_CLIENT_ID_1}&since=-1')
+    resync = encryption_helper.decrypt_msg(EncryptedMessageRequest(**({'client_id': TEST_CLIENT_ID_1} | response.json())))
+    assert resync['full']
+    assert resync['names'][-2:] == ['delta_user', 'delta_user']
+
+@pytest.mark.asyncio
+async def test_match_faces(test_client: AsyncTestClient, isolated_storage: EncodingsStore) -> None:
+    matrix, names = isolated_storage.load()
+    probe = matrix[0].tolist()
+    data = {'encodings': [probe, [5.0] * 128], 'top_k': 2}
+    encrypted_data = {'client_id': TEST_CLIENT_ID_1} | encryption_helper.encrypt_msg(data, TEST_CLIENT_ID_1)
+    response = await test_client.post('/faces/match', json=encrypted_data)
+    assert response.status_code == 201
+    matches = encryption_helper.decrypt_msg(EncryptedMessageRequest(**({'client_id': TEST_CLIENT_ID_1} | response.json())))['matches']
+    assert matches[0][0]['username'] == names[0]
+    assert matches[0][0]['distance'] < 1e-6
+    assert matches[1] == [] # nothing within tolerance
+
+    data = {'encodings': [[0.0] * 3]}
+    encrypted_data = {'client_id': TEST_CLIENT_ID_1} | encryption_helper.encrypt_msg(data, TEST_CLIENT_ID_1)
+    response = await test_client.post('/faces/match', json=encrypted_data)
+    assert response.status_code == 400
+
+def test_ann_index() -> None:
+    rng = np.random.default_rng(1)
+    centres = rng.normal(scale=0.3, size=(50, 128))
+    matrix = centres.repeat(20, axis=0) + rng.normal(scale=0.03, size=(1000, 128))
+    names = [f'user{i}' for i in range(50) for _ in range(20)]
+
+    index = IVFIndex(nlist=16, nprobe=4)
+    index.build(matrix[:800])
+    index.add(matrix[800:])
+    assert index.rows == 1000 and sum(len(cell) for cell in index.lists) == 1000
+
+    probes = matrix[::50] + rng.normal(scale=0.01, size=(20, 128))
+    assert index.measure_recall(matrix, probes, k=10)['recall'] > 0.9
+    assert index.measure_recall(matrix, probes, k=10, nprobe=16)['recall'] == 1.0
+
+    exact = FaceMatcher(matrix, names).match(probes, top_k=3)
+    approximate = FaceMatcher(matrix, names, index, nprobe=16).match(probes, top_k=3)
+    assert [[m['username'] for m in p] for p in approximate] == [[m['username'] for m in p] for p in exact]
+    assert approximate[0][0]['distance'] == pytest.approx(exact[0][0]['distance'])
+
+def test_encodings_cache_ann_append(tmp_path) -> None:
+    rng = np.random.default_rng(3)
+    store = EncodingsStore(directory=str(tmp_path), legacy_pickle=None)
+    for i in range(10):
+        store.append(f'user{i}', rng.normal(scale=0.3, size=(10, 128)))
+    cache = EncodingsCache(store, ann_nprobe=4, ann_nlist=4, ann_min_rows=50)
+    old = cache.matcher()
+    probe = np.asarray(cache.load()[0][:1])
+
+    store.append('late', rng.normal(scale=0.3, size=(20, 128)))
+    new = cache.matcher()
+    assert new.index is not old.index and new.index.rows == 120
+    # The old matcher's index still only refers to the rows of its own matrix
+    assert old.index.rows == 100 and max(cell.max() for cell in old.index.lists if len(cell)) < 100
+    assert old.match(probe, top_k=1)[0][0]['username'] == 'user0'
+    assert new.match(probe, top_k=1)[0][0]['username'] == 'user0'
+
+def test_face_templates(tmp_path) -> None:
+    rng = np.random.default_rng(2)
+    frames = np.concatenate([np.full((10, 128), 0.1), np.full((5, 128), 0.2)]) + rng.normal(scale=0.001, size=(15, 128))
+    templates = compact_templates(frames, max_templates=5, dedupe_distance=0.1)
+    assert len(templates) == 3 # centroid plus one template per cluster, the near-duplicates are dropped
+    assert len(compact_templates(frames, max_templates=2)) == 2
+
+    store = EncodingsStore(directory=str(tmp_path), legacy_pickle=None)
+    store.append('alice', rng.normal(size=(4, 128)))
+    store.append('bob', rng.normal(size=(6, 128)))
+    version = store.index()['version']
+    store.append('carol', rng.normal(size=(2, 128)))
+    index = store.replace('alice', frames, merge=lambda existing, new: compact_templates(np.concatenate([existing, new]), 3))
+    matrix, names = store.load(index)
+    assert names == ['bob'] * 6 + ['carol'] * 2 + ['alice'] * 3
+
+    removed, added = store.changes_since(index, version)
+    assert removed == ['alice']
+    assert [run[0] for run in added] == ['carol', 'alice']
+    assert [names[offset] for _, offset, _ in added] == ['carol', 'alice']
+
+def test_compact_store_concurrent_append(monkeypatch, tmp_path) -> None:
+    rng = np.random.default_rng(4)
+    store = EncodingsStore(directory=str(tmp_path), legacy_pickle=None)
+    store.append('alice', rng.normal(size=(8, 128)))
+    appender = threading.Thread(target=store.append, args=('bob', rng.normal(size=(2, 128))))
+
+    def compacting(encodings, max_templates, dedupe_distance):
+        if not appender.is_alive():
+            appender.start()
+            appender.join(timeout=0.2)
+            assert appender.is_alive() # waits for the rewrite
+        return compact_templates(encodings, max_templates, dedupe_distance)
+
+    monkeypatch.setattr(face_templates, 'compact_templates', compacting)
+    compact_store(store, max_templates=3)
+    appender.join()
+    matrix, names = store.load()
+    assert names == ['alice'] * 3 + ['bob'] * 2
+
+@pytest.mark.asyncio
+async def test_quantized_encodings(test_client: AsyncTestClient, isolated_storage: EncodingsStore) -> None:
+    matrix, names = isolated_storage.load()
+    matrix = np.asarray(matrix)
+    for fmt, error in [('f16', 1e-3), ('i8', 1e-2)]:
+        response = await test_client.get(f'/encodings?client_id={TEST_CLIENT_ID_1}&format={fmt}')
+        assert response.status_code == 200
+        data = encryption_helper.decrypt_msg(EncryptedMessageRequest(**({'client_id': TEST_CLIENT_ID_1} | response.json())))
+        assert data['format'] == fmt and data['names'] == names
+        decoded = decode_matrix(data['encodings'], fmt, data['dim'], data.get('scales'))
+        assert np.abs(decoded - matrix).max() < error
+
+        data = {'format': fmt, 'top_k': 1} | encode_matrix(matrix[:1], fmt)
+        encrypted_data = {'client_id': TEST_CLIENT_ID_1} | encryption_helper.encrypt_msg(data, TEST_CLIENT_ID_1)
+        response = await test_client.post('/faces/match', json=encrypted_data)
+        assert response.status_code == 201
+        matches = encryption_helper.decrypt_msg(EncryptedMessageRequest(**({'client_id': TEST_CLIENT_ID_1} | response.json())))['matches']
+        assert matches[0][0]['username'] == names[0]
+
+    response = await test_client.get(f'/encodings?client_id={TEST_CLIENT_ID_1}&format=f32')
+    assert response.status_code == 400
+
+def test_face_encoder_pool(tmp_path) -> None:
+    frames = []
+    for i in range(6):
+        path = str(tmp_path / f'frame_{i}.jpg')
+        cv2.imwrite(path, np.full((64, 64, 3), 40 * i, dtype=np.uint8))
+        frames.append(path)
+    frames.append(str(tmp_path / 'missing.jpg'))
+    # In-memory RGB frames give the same encodings as image files
+    frames.append(np.full((64, 64, 3), 40, dtype=np.uint8))
+
+    def as_lists(results):
+        return [[encoding.tolist() for encoding in encodings] for encodings in results]
+
+    # Without tracking every frame gets the same full detection as encode_tracked without a hint. The
+    # frames may well have no face, so only the order and equality of the results are checked.
+    pool = FaceEncoderPool(processes=2, track=False)
+    try:
+        results = pool.encode(frames)
+        assert as_lists(pool.encode(frames[:1])) == as_lists(results[:1]) # the pool is reused
+    finally:
+        pool.close()
+    assert as_lists(results) == as_lists(face_encoder.encode_tracked(frame)[0] for frame in frames)
+    assert results[-2] == []
+    assert as_lists(results[-1:]) == as_lists(results[1:2])
+
+def test_default_encoder_processes(monkeypatch) -> None:
+    monkeypatch.setattr(face_worker.os, 'cpu_count', lambda: 8)
+    monkeypatch.setattr(face_worker, 'available_memory', lambda: 256 * 1024 * 1024)
+    assert face_worker.default_encoder_processes(1) == 1 # a 256M container fits one
+    monkeypatch.setattr(face_worker, 'available_memory', lambda: 64 * 1024 ** 3)
+    assert face_worker.default_encoder_processes(2) == 4 # CPU bound
+
+def _append_encodings(directory: str, username: str) -> None:
+    store = EncodingsStore(directory, legacy_pickle=None)
+    for i in range(10):
+        store.append(username, np.full((2, 128), i, dtype=np.float64))
+
+def test_encodings_store_concurrent_appends(tmp_path) -> None:
+    directory = str(tmp_path / 'encodings')
+    store = EncodingsStore(directory, legacy_pickle=None)
+    store.index()
+    processes = [multiprocessing.Process(target=_append_encodings, args=(directory, f'user{i}')) for i in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    index = store.index()
+    matrix, names = store.load(index)
+    assert index['count'] == len(names) == 80 and index['version'] == 41 # creation plus 40 appends
+    assert len(index['segments']) < MAX_SEGMENTS
+    for i in range(4):
+        rows = np.asarray(matrix)[np.asarray(names) == f'user{i}']
+        assert sorted(rows[:, 0].tolist()) == sorted(list(range(10)) * 2)
+
+    store.compact()
+    compacted, compacted_names = store.load()
+    assert isinstance(compacted, np.memmap) and compacted_names == names
+    assert np.array_equal(compacted, matrix)
+
+def test_sample_frames(tmp_path) -> None:
+    # 30 fps for 5 seconds: skip the first 0.5s (15 frames), then 20 evenly spaced frames
+    timestamps = [i / 30 for i in range(150)]
+    indices = sample_indices(timestamps)
+    assert len(indices) == 20 and indices[0] > 15 and indices[-1] < 150
+    assert sample_indices(timestamps[:18]) == [] # too short
+
+    if shutil.which('ffmpeg') is None:
+        pytest.skip('ffmpeg is not installed')
+    # WebM as recorded by browsers, without a duration in its header
+    video_path = str(tmp_path / 'video.webm')
+    subprocess.run(['ffmpeg', '-f', 'lavfi', '-i', 'testsrc=duration=3:size=160x120:rate=30', '-c:v', 'libvpx',
+                    '-f', 'webm', '-live', '1', '-y', video_path], check=True, capture_output=True)
+    frames = sample_frames(video_path, str(tmp_path / 'frames'))
+    assert len(frames) == 20 and all(os.path.exists(frame) for frame in frames)
+    frames = list(iter_frames(video_path))
+    assert len(frames) == 20 and all(frame.shape == (120, 160, 3) for frame in frames)
+
+@pytest.mark.asyncio
+async def test_register_face_stream(test_client: AsyncTestClient, isolated_storage: EncodingsStore, tmp_path) -> None:
+    response = await test_client.post('/register/face/stream?mac_address=00:00:00:00:00:00', content=b'webm')
+    assert response.status_code == 404
+    response = await test_client.post('/register/face/stream', content=b'webm')
+    assert response.status_code == 400
+
+    if shutil.which('ffmpeg') is None:
+        pytest.skip('ffmpeg is not installed')
+    mac_address = await registered_device(test_client, 'aa:bb:cc:dd:ee:04', 'stream_user')
+
+    video_path = str(tmp_path / 'video.webm')
+    subprocess.run(['ffmpeg', '-f', 'lavfi', '-i', 'testsrc=duration=3:size=160x120:rate=30', '-c:v', 'libvpx',
+                    '-f', 'webm', '-live', '1', '-y', video_path], check=True, capture_output=True)
+
+    async def chunks():
+        with open(video_path, 'rb') as f:
+            while chunk := f.read(4096):
+                yield chunk
+
+    response = await test_client.post(f'/register/face/stream?mac_address={mac_address}', content=chunks())
+    assert response.status_code == 201
+    job = response.json()
+    assert job['status'] == 'done'
+    response = await test_client.get(f"/register/face/{job['job_id']}")
+    assert response.json()['status'] == 'done'
+
+def test_face_tracking(fake_face_recognition: FakeFaceRecognition) -> None:
+    def frame(top, left):
+        image = np.zeros((480, 640, 3), dtype=np.uint8)
+        image[top:top + 100, left:left + 100] = 255
+        return image
+
+    encodings, box, scanned = face_encoder.encode_tracked(frame(100, 200))
+    assert box == (100, 300, 200, 200) and scanned == 480 * 640
+
+    # The face moved a little: only the padded region around the previous box is searched
+    encodings, box, scanned = face_encoder.encode_tracked(frame(110, 220), box)
+    assert box == (110, 320, 210, 220) and scanned == 200 * 200
+    assert encodings[0][0] == 110
+
+    # The face left the region: fall back to the whole image
+    encodings, box, scanned = face_encoder.encode_tracked(frame(350, 500), box)
+    assert box == (350, 600, 450, 500) and scanned == 200 * 200 + 480 * 640
+
+    # Detection on a half-size copy, with the box mapped back to full resolution
+    boxes, scanned = face_encoder.detect_faces(frame(100, 200), scale=0.5)
+    assert boxes == [(100, 300, 200, 200)] and scanned == 240 * 320
+    encodings, box, scanned = face_encoder.encode_tracked(frame(110, 220), (100, 300, 200, 200), scale=0.5)
+    assert box == (110, 320, 210, 220) and encodings[0][0] == 110 # encoded from the original pixels
+
+def test_encoding_budget() -> None:
+    rng = np.random.default_rng(0)
+    sharp = rng.integers(0, 256, (240, 320, 3), dtype=np.uint8)
+    blurry = np.full((240, 320, 3), 128, dtype=np.uint8)
+    blurry[:, 160:] = 140 # one soft edge
+    dark = (sharp // 10).astype(np.uint8)
+
+    ranked = rank_frames([blurry, dark, sharp])
+    assert len(ranked) == 1 and ranked[0] is sharp
+    # Nothing passes: keep everything, sharpest first
+    assert [frame is dark for frame in rank_frames([blurry, dark])] == [True, False]
+
+    budget = EncodingBudget(3)
+    face = np.full(128, 0.1)
+    budget.add([face, face + 0.001]) # near-identical
+    budget.add([face + 1.0]) # someone else
+    assert len(budget.kept) == 1 and budget.duplicates == 1 and budget.inconsistent == 1 and not budget.done
+    budget.add([face + 0.01, face - 0.01])
+    assert budget.done
+
+@pytest.mark.asyncio
+async def test_register_face_duplicate(test_client: AsyncTestClient, isolated_storage: EncodingsStore) -> None:
+    mac_address = await registered_device(test_client, 'aa:bb:cc:dd:ee:05', 'retry_user')
+
+    def upload(video: bytes, replace: bool = False, **headers):
+        return test_client.post('/register/face', data={'mac_address': mac_address, 'replace': replace}, headers=headers,
+                                files={'video': ('video.webm', video, 'video/webm')})
+
+    first = (await upload(b'first')).json()['job_id']
+    # Same content, or same idempotency key: the earlier job, nothing new on disk
+    assert (await upload(b'first')).json()['job_id'] == first
+    keyed = (await upload(b'second', **{'Idempotency-Key': 'abc'})).json()['job_id']
+    assert keyed != first
+    assert (await upload(b'third', **{'Idempotency-Key': 'abc'})).json()['job_id'] == keyed
+    assert sorted(os.listdir(server.VIDEOS_DIR)) == sorted([first, keyed])
+    # Only the latest job counts as a repeat
+    latest = (await upload(b'first')).json()['job_id']
+    assert latest not in (first, keyed)
+    # The same video re-uploaded to replace the encodings is a new registration
+    replacing = (await upload(b'first', replace=True)).json()['job_id']
+    assert replacing != latest
+    assert (await upload(b'first', replace=True)).json()['job_id'] == replacing
+
+def test_train_model_replace(fake_face_recognition: FakeFaceRecognition, tmp_path) -> None:
+    store = EncodingsStore(str(tmp_path), legacy_pickle=None)
+    frames = [np.full((32, 32, 3), value, dtype=np.uint8) for value in (50, 100)]
+    assert train_model(frames, 'user', store) == 2
+    assert train_model(frames[:1], 'user', store) == 1
+    assert len(store.load()[0]) == 3
+
+    assert train_model(frames[1:], 'user', store, replace=True) == 1
+    matrix, names = store.load()
+    assert names == ['user'] and matrix[0][-1] == 100 / 255
+    # No face found: the old encodings are kept
+    assert train_model([np.zeros((32, 32, 3), dtype=np.uint8)], 'user', store, replace=True) == 0
+    assert len(store.load()[0]) == 1
+
+def test_reenroll(fake_face_recognition: FakeFaceRecognition, monkeypatch, tmp_path) -> None:
+    for username, values in {'alice': (10, 20), 'bob': (30,)}.items():
+        os.makedirs(tmp_path / 'input' / username)
+        for i, value in enumerate(values):
+            cv2.imwrite(str(tmp_path / 'input' / username / f'{i}.png'), np.full((16, 16, 3), value, dtype=np.uint8))
+
+    store = EncodingsStore(str(tmp_path / 'encodings'), legacy_pickle=None)
+    store.append('carol', [np.zeros(128)])
+    checkpoint = str(tmp_path / 'checkpoint')
+    settings = {'track': True, 'scale': 1.0, 'budget': 0, 'max_templates': 0, 'dedupe_distance': 0.1}
+
+    # bob fails: alice is checkpointed and the store is left alone
+    encode_user = reenroll.encode_user
+    def failing(paths, settings):
+        if 'bob' in paths[0]:
+            raise RuntimeError('interrupted')
+        return encode_user(paths, settings)
+    monkeypatch.setattr(reenroll, 'encode_user', failing)
+    assert reenroll.reenroll(str(tmp_path / 'input'), store, checkpoint, settings, processes=1) is None
+    assert os.path.exists(os.path.join(checkpoint, 'alice.npy')) and store.load()[1] == ['carol']
+
+    # The next run only encodes bob, then swaps the store
+    encoded = []
+    monkeypatch.setattr(reenroll, 'encode_user', lambda paths, settings: encoded.append(paths) or encode_user(paths, settings))
+    assert reenroll.reenroll(str(tmp_path / 'input'), store, checkpoint, settings, processes=1) is not None
+    assert len(encoded) == 1 and 'bob' in encoded[0][0]
+    matrix, names = store.load()
+    assert names == ['alice', 'alice', 'bob'] and round(matrix[2][-1] * 255) == 30
+    assert not os.path.exists(checkpoint)
+
+@pytest.mark.asyncio
+async def test_bounded_executor(test_client: AsyncTestClient) -> None:
+    executor = BoundedExecutor('test', 1, max_queue=1)
+    release = threading.Event()
+    try:
+        running = asyncio.ensure_future(executor.run(release.wait))
+        waiting = asyncio.ensure_future(executor.run(lambda: 'done'))
+        await asyncio.sleep(0.05)
+        assert executor.stats() == {'workers': 1, 'running': 1, 'queued': 1, 'max_queued': 1, 'max_queue': 1,
+                                    'completed': 0, 'rejected': 0}
+        # The queue is full
+        with pytest.raises(HTTPException) as e:
+            await executor.run(lambda: None)
+        assert e.value.status_code == 503
+    finally:
+        release.set()
+    assert await running and await waiting == 'done'
+    assert executor.stats()['completed'] == 2 and executor.stats()['rejected'] == 1
+    executor.shutdown()
+    assert await executor.run(lambda: 1) == 1 # restarted
+    executor.shutdown()
+
+    response = await test_client.get('/stats')
+    assert set(response.json()['executors']) == {'io', 'vision'}
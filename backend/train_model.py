@@ -1,40 +1,74 @@
-import os
-from imutils import paths
-import face_recognition
-import pickle
-import cv2
+import numpy as np
+from encodings_store import EncodingsStore
+from face_encoder import FaceEncoderPool, EncodingBudget, encode_tracked, rank_frames, DETECT_SCALE
+from face_templates import compact_templates, DEFAULT_DEDUPE_DISTANCE
 
-def train_model(frame_paths, username):
-    print("[INFO] start processing faces...")
+def encode_faces(frames, pool: FaceEncoderPool = None, track: bool = True, scale: float = DETECT_SCALE, budget: int = 0) -> list:
+    # frames are RGB arrays (e.g. from video_encoding.iter_frames) or image paths
+    newEncodings = []
+    encoding_budget = None
+    if budget:
+        # best frames first, stopping once there are budget distinct encodings of the same face
+        frames = rank_frames(frames)
+        encoding_budget = EncodingBudget(budget)
 
-    if os.path.exists("encodings.pickle") and os.path.getsize("encodings.pickle") > 0:
-        with open("encodings.pickle", "rb") as f:
-            data = pickle.loads(f.read())
-        knownEncodings = data['encodings']
-        knownNames = data['names']
+    if pool is not None:
+        print(f"[INFO] processing images on {pool.processes} processes")
+        frame_encodings = pool.encode(frames, encoding_budget)
     else:
-        knownEncodings = []
-        knownNames = []
-
-    for (i, imagePath) in enumerate(frame_paths):
-        print(f"[INFO] processing image {i + 1}/{len(frame_paths)}")
-        
-        image = cv2.imread(imagePath)
-        if image is None:
-            print(f"[WARNING] could not read image {imagePath}, skipping.")
-            continue
-        rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        
-        boxes = face_recognition.face_locations(rgb, model="hog")
-        encodings = face_recognition.face_encodings(rgb, boxes)
-        
-        for encoding in encodings:
-            knownEncodings.append(encoding)
-            knownNames.append(username)
+        # with track, each frame is first searched around the face found in the previous one
+        frame_encodings = []
+        hint, scanned_pixels = None, 0
+        for (i, frame) in enumerate(frames):
+            print(f"[INFO] processing image {i + 1}")
+            encodings, box, scanned = encode_tracked(frame, hint, scale)
+            frame_encodings.append(encodings)
+            scanned_pixels += scanned
+            hint = box if track else None
+            if encoding_budget is not None:
+                encoding_budget.add(encodings)
+                if encoding_budget.done:
+                    break
+        print(f"[INFO] face detection scanned {scanned_pixels} pixels")
+
+    if encoding_budget is not None:
+        print(f"[INFO] encoded {len(frame_encodings)} of {len(frames)} frames, dropped {encoding_budget.duplicates} "
+              f"duplicate and {encoding_budget.inconsistent} inconsistent encodings")
+        return encoding_budget.kept
+    for encodings in frame_encodings:
+        newEncodings.extend(encodings)
+    return newEncodings
+
+def train_model(frames, username, store: EncodingsStore = None, max_templates: int = 0,
+                dedupe_distance: float = DEFAULT_DEDUPE_DISTANCE, pool: FaceEncoderPool = None, track: bool = True,
+                scale: float = DETECT_SCALE, budget: int = 0, replace: bool = False):
+    print("[INFO] start processing faces...")
+    newEncodings = encode_faces(frames, pool, track, scale, budget)
+    return store_encodings(newEncodings, username, store, max_templates, dedupe_distance, replace)
 
+def store_encodings(newEncodings: list, username, store: EncodingsStore = None, max_templates: int = 0,
+                    dedupe_distance: float = DEFAULT_DEDUPE_DISTANCE, replace: bool = False):
+    store = store or EncodingsStore()
     print("[INFO] serializing encodings...")
-    data = {"encodings": knownEncodings, "names": knownNames}
-    with open("encodings.pickle", "wb") as f:
-        f.write(pickle.dumps(data))
+    if replace and not newEncodings:
+        # a failed re-registration shouldn't leave the user with no encodings at all
+        print(f"[WARNING] no faces found, keeping {username}'s existing encodings")
+        return 0
+
+    if max_templates:
+        # keep a few templates per user (including earlier registrations unless replacing) instead of every frame's encoding
+        def merge(existing, new):
+            return compact_templates(new if replace else np.concatenate([existing, new]), max_templates, dedupe_distance)
+        store.replace(username, newEncodings, merge=merge)
+        print(f"[INFO] Training complete. {len(newEncodings)} encodings compacted into '{store.directory}'")
+        return len(newEncodings)
+
+    if replace:
+        store.replace(username, newEncodings)
+        print(f"[INFO] Training complete. {username}'s encodings replaced with {len(newEncodings)} in '{store.directory}'")
+        return len(newEncodings)
+
+    store.append(username, newEncodings)
 
-    print("[INFO] Training complete. Encodings saved to 'encodings.pickle'")
\ No newline at end of file
+    print(f"[INFO] Training complete. {len(newEncodings)} encodings appended to '{store.directory}'")
+    return len(newEncodings)
@@ -1,73 +1,185 @@
+import asyncio
+import json
 import subprocess
 import logging
+from collections.abc import AsyncIterator, Iterator
 from litestar.exceptions import HTTPException
-import cv2
+import numpy as np
 import os
-import shutil
 
-def convert_to_mp4(webm_path: str, mp4_path: str) -> None:
-    """Convert a WebM file to MP4 using ffmpeg."""
-    # Common options: -c:v libx264 for video, -c:a aac for audio.
-    # Adjust as needed for your environment/codecs.
+# Frames sampled per registration video, after skipping the first SKIP_SECONDS (camera stabilization)
+FRAME_COUNT = 20
+SKIP_SECONDS = 0.5
+MIN_FRAMES = 5
+# A stream's length isn't known until it ends, so streamed uploads are sampled at a fixed rate instead
+STREAM_SAMPLE_FPS = 4
+
+def probe_video(video_path: str) -> tuple[list[float], int, int]:
+    """Return the presentation time of every video frame and the frame width and height.
+
+    Only packets are read (no decoding). Browser-recorded WebM usually has no duration or frame count in
+    its header, which is why the video used to be transcoded to MP4 first. Demuxing the packets gives
+    the exact frame count cheaply instead.
+    """
     command = [
-        'ffmpeg',
-        '-i', webm_path,
-        '-c:v', 'libx264',
-        '-c:a', 'aac',
-        '-strict', 'experimental',  # Sometimes needed for aac
-        '-y',  # Overwrite without asking
-        mp4_path
+        'ffprobe',
+        '-v', 'error',
+        '-select_streams', 'v:0',
+        '-show_entries', 'stream=width,height:packet=pts_time',
+        '-of', 'json',
+        video_path
     ]
     try:
-        subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        result = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        info = json.loads(result.stdout)
+        stream = info['streams'][0]
     except subprocess.CalledProcessError as e:
-        logging.error(f"FFmpeg conversion failed: {e.stderr.decode('utf-8', errors='replace')}")
-        raise HTTPException(status_code=500, detail="Failed to convert WebM to MP4")
-    
-def split_frames(mp4_path: str, user_video_dir: str):
-    # Grab 5 frames from the video
-    cap = cv2.VideoCapture(mp4_path)
-
-    if not cap.isOpened():
-        logging.error("Error opening video file")
-        return {'status': 'error', 'detail': 'Error opening video file'}
-    
-    fps = cap.get(cv2.CAP_PROP_FPS)
-    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    duration_sec = total_frames / fps if fps else 0
-    skip_frames = int(0.5 * fps) # skip first 0.5 seconds - camera stabilization
-
-    logging.info(f"Video info - FPS: {fps}, Total frames: {total_frames}, Duration: {duration_sec:.2f}s")
+        logging.error(f"FFprobe failed: {e.stderr.decode('utf-8', errors='replace')}")
+        raise HTTPException(status_code=500, detail="Failed to read video")
+    except (ValueError, KeyError, IndexError):
+        raise HTTPException(status_code=400, detail="Upload has no video stream")
+    times = sorted(float(packet['pts_time']) for packet in info.get('packets', []) if packet.get('pts_time') not in (None, 'N/A'))
+    return times, stream['width'], stream['height']
+
+def sample_indices(timestamps: list[float], count: int = FRAME_COUNT, skip_seconds: float = SKIP_SECONDS) -> list[int]:
+    """Pick up to count evenly spaced frame numbers after the first skip_seconds."""
+    start = timestamps[0] if timestamps else 0
+    skip_frames = sum(1 for t in timestamps if t - start < skip_seconds)
+    total_frames = len(timestamps)
+    if (total_frames - skip_frames) < MIN_FRAMES:
+        return []
+    interval = max(1, (total_frames - skip_frames) // (count + 1))
+    return [skip_frames + i * interval for i in range(1, count + 1) if skip_frames + i * interval < total_frames]
+
+def _sample(video_path: str, count: int) -> tuple[list[int], int, int]:
+    timestamps, width, height = probe_video(video_path)
+    duration_sec = timestamps[-1] - timestamps[0] if timestamps else 0
+    logging.info(f"Video info - Total frames: {len(timestamps)}, Duration: {duration_sec:.2f}s, Size: {width}x{height}")
 
     # not really necessary - but just in case
-    if duration_sec < 2: 
+    if duration_sec < 2:
         logging.warning("Video duration is shorter than 2 seconds—check the frontend code or device recording.")
-    if (total_frames - skip_frames) < 5:
+    indices = sample_indices(timestamps, count)
+    if not indices:
         logging.error("Video too short")
-        return {'status': 'error', 'detail': 'Video too short'}
+        raise HTTPException(status_code=400, detail="Video too short")
+    return indices, width, height
 
-    interval = max(1, (total_frames - skip_frames) // 21)
+def _decode_command(video_path: str, indices: list[int]) -> list[str]:
+    # ffmpeg's select filter drops all the other frames right after decoding: one sequential pass, no seeks
+    select = '+'.join(f'eq(n\\,{i})' for i in indices)
+    return [
+        'ffmpeg',
+        '-v', 'error',
+        '-i', video_path,
+        '-vf', f'select={select}',
+        '-vsync', 'vfr', # one output image per selected frame
+        '-frames:v', str(len(indices))
+    ]
+
+def iter_frames(video_path: str, count: int = FRAME_COUNT) -> Iterator[np.ndarray]:
+    """Decode the video once and yield the sampled frames as (height, width, 3) RGB arrays.
 
-    frames_dir = os.path.join(user_video_dir, "frames")
+    The frames come straight from ffmpeg's stdout as raw RGB, so nothing is written to disk or re-encoded.
+    """
+    indices, width, height = _sample(video_path, count)
+    command = _decode_command(video_path, indices) + ['-f', 'rawvideo', '-pix_fmt', 'rgb24', 'pipe:1']
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    finished = False
+    try:
+        for i in range(len(indices)):
+            frame = np.empty((height, width, 3), dtype=np.uint8)
+            if process.stdout.readinto(memoryview(frame).cast('B')) < frame.nbytes:
+                logging.warning(f"Error reading frame {i + 1}")
+                break
+            yield frame
+        finished = True
+    finally:
+        if not finished: # the consumer stopped early
+            process.kill()
+        process.stdout.close()
+        stderr = process.stderr.read()
+        process.stderr.close()
+        if process.wait() != 0 and finished:
+            logging.error(f"FFmpeg frame extraction failed: {stderr.decode('utf-8', errors='replace')}")
+            raise HTTPException(status_code=500, detail="Failed to extract frames")
+
+def sample_frames(video_path: str, frames_dir: str, count: int = FRAME_COUNT) -> list[str]:
+    """Like iter_frames, but save the sampled frames as JPEGs and return their paths (for debugging)."""
+    indices, _, _ = _sample(video_path, count)
     os.makedirs(frames_dir, exist_ok=True)
+    command = _decode_command(video_path, indices) + ['-q:v', '2', '-y', os.path.join(frames_dir, 'frame_%d.jpg')]
+    try:
+        subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except subprocess.CalledProcessError as e:
+        logging.error(f"FFmpeg frame extraction failed: {e.stderr.decode('utf-8', errors='replace')}")
+        raise HTTPException(status_code=500, detail="Failed to extract frames")
 
     extracted_frames = []
-    for i in range(1, 21):
-        
-        frame_idx = skip_frames + i * interval
-        if frame_idx >= total_frames: # in case of rounding / video shorter than expected
-            break
-        
-        cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
-        ret, frame = cap.read()
-        if not ret or frame is None:
-            logging.warning(f"Error reading frame {i}")
-            continue
-        
+    for i in range(1, len(indices) + 1):
         frame_path = os.path.join(frames_dir, f'frame_{i}.jpg')
-        cv2.imwrite(frame_path, frame)
-        extracted_frames.append(frame_path)
-        logging.info(f"Saved frame {i} to {frame_path}")
+        if os.path.exists(frame_path):
+            extracted_frames.append(frame_path)
+        else:
+            logging.warning(f"Error reading frame {i}")
+    return extracted_frames
+
+async def _read_ppm_frames(stdout: asyncio.StreamReader, frames: list) -> None:
+    # Each frame is a binary PPM: "P6\n<width> <height>\n255\n" followed by the raw RGB24 pixels
+    while True:
+        try:
+            header = [await stdout.readuntil(b'\n') for _ in range(3)]
+        except asyncio.IncompleteReadError:
+            return
+        width, height = map(int, header[1].split())
+        pixels = await stdout.readexactly(width * height * 3)
+        frames.append(np.frombuffer(bytearray(pixels), dtype=np.uint8).reshape(height, width, 3))
+
+async def stream_frames(chunks: AsyncIterator[bytes], count: int = FRAME_COUNT, fps: float = STREAM_SAMPLE_FPS) -> list[np.ndarray]:
+    """Pipe an upload into ffmpeg as it arrives and return up to count RGB frames sampled from it.
 
-    cap.release()
-    return extracted_frames
\ No newline at end of file
+    Decoding overlaps with the network transfer and nothing is written to disk. Frames are taken at fps
+    after the first SKIP_SECONDS, so memory is bounded by one chunk plus the sampled frames. Limit the
+    upload size with the route's request_max_body_size.
+    """
+    process = await asyncio.create_subprocess_exec(
+        'ffmpeg',
+        '-v', 'error',
+        '-i', 'pipe:0',
+        '-ss', str(SKIP_SECONDS), # decoded and dropped, pipes can't seek
+        '-vf', f'fps={fps}',
+        '-frames:v', str(count),
+        '-f', 'image2pipe',
+        '-c:v', 'ppm',
+        'pipe:1',
+        stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+
+    async def feed() -> None:
+        try:
+            async for chunk in chunks:
+                process.stdin.write(chunk)
+                await process.stdin.drain()
+            process.stdin.close()
+        except (BrokenPipeError, ConnectionResetError):
+            # ffmpeg has all the frames it needs (or failed, reported below). Still read the rest of the
+            # upload, so the caller sees all of it (e.g. to hash it).
+            async for _ in chunks:
+                pass
+
+    frames = []
+    try:
+        _, _, stderr = await asyncio.gather(feed(), _read_ppm_frames(process.stdout, frames), process.stderr.read())
+    finally:
+        if process.returncode is None:
+            process.kill()
+        await process.wait()
+
+    if process.returncode != 0 and not frames:
+        logging.error(f"FFmpeg frame extraction failed: {stderr.decode('utf-8', errors='replace')}")
+        raise HTTPException(status_code=400, detail="Failed to decode video")
+    logging.info(f"Sampled {len(frames)} frames from the streamed video")
+    if len(frames) < MIN_FRAMES:
+        logging.error("Video too short")
+        raise HTTPException(status_code=400, detail="Video too short")
+    return frames